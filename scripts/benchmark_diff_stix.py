@@ -0,0 +1,409 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from diff_stix import DiffStix
+
+# helper maps
+domainToObjectCounts = { # approximate number of each kind of object in each domain at 1x scale
+    "enterprise-attack": {
+        "technique": 550,   # techniques and sub-techniques
+        "software": 600,
+        "group": 130,
+        "mitigation": 280,
+        "uses": 9000,       # relationships from software and groups to techniques
+        "mitigates": 1100   # relationships from mitigations to techniques
+    },
+    "mobile-attack": {
+        "technique": 90,
+        "software": 90,
+        "group": 10,
+        "mitigation": 15,
+        "uses": 600,
+        "mitigates": 150
+    }
+}
+domainToSourceName = {
+    "enterprise-attack": "mitre-attack",
+    "mobile-attack": "mitre-mobile-attack"
+}
+domainToTactics = {
+    "enterprise-attack": ["initial-access", "execution", "persistence", "privilege-escalation", "defense-evasion", "credential-access", "discovery", "lateral-movement", "collection", "command-and-control", "exfiltration", "impact"],
+    "mobile-attack": ["initial-access", "execution", "persistence", "privilege-escalation", "defense-evasion", "credential-access", "discovery", "lateral-movement", "collection", "command-and-control", "exfiltration", "impact", "network-effects", "remote-service-effects"]
+}
+attackTypeToStixTypes = {
+    "technique": ["attack-pattern"],
+    "software": ["malware", "tool"],
+    "group": ["intrusion-set"],
+    "mitigation": ["course-of-action"]
+}
+attackTypeToIdPrefix = {
+    "technique": "T",
+    "software": "S",
+    "group": "G",
+    "mitigation": "M"
+}
+attackTypeToUrlPath = {
+    "technique": "techniques",
+    "software": "software",
+    "group": "groups",
+    "mitigation": "mitigations"
+}
+fractionDefaults = { # default fraction of the objects of each type in each section of the diff
+    "additions": 0.05,
+    "changes": 0.10,
+    "minor_changes": 0.10,
+    "revocations": 0.02,
+    "deprecations": 0.02,
+    "deletions": 0.01,
+    "subtechniques": 0.65 # fraction of the techniques which are sub-techniques
+}
+
+
+class BundleGenerator(object):
+    """
+    Generate pairs of old and new synthetic bundles shaped like the enterprise and mobile ATT&CK domains.
+    """
+    def __init__(self, scale=1, fractions=fractionDefaults, seed=0):
+        """
+        Construct a new 'BundleGenerator' object.
+
+        params:
+            scale: multiplier for the number of objects and relationships in domainToObjectCounts
+            fractions: dict of the fraction of the objects of each type which are added, changed, minor changed, revoked,
+                deprecated and deleted in the new bundle, and of the techniques which are sub-techniques
+            seed: seed for the random number generator, so that the same arguments always generate the same bundles
+        """
+        self.scale = scale
+        self.fractions = fractions
+        self.random = random.Random(seed)
+
+
+    def stix_id(self, stix_type):
+        return f"{stix_type}--{uuid.UUID(int=self.random.getrandbits(128), version=4)}"
+
+
+    def timestamp(self, day):
+        return f"2020-{1 + day // 28:02d}-{1 + day % 28:02d}T00:00:00.000Z"
+
+
+    def sdo(self, domain, obj_type, index, external_id=None, url=None):
+        """
+        Create an object of the given ATT&CK type.
+        """
+        stix_type = self.random.choice(attackTypeToStixTypes[obj_type])
+        external_id = external_id or f"{attackTypeToIdPrefix[obj_type]}{index:04d}"
+        obj = {
+            "type": stix_type,
+            "id": self.stix_id(stix_type),
+            "created": self.timestamp(0),
+            "modified": self.timestamp(0),
+            "name": f"{obj_type.capitalize()} {external_id}",
+            "description": f"Synthetic {obj_type} {external_id}. " * 8,
+            "external_references": [{
+                "source_name": domainToSourceName[domain],
+                "external_id": external_id,
+                "url": url or f"https://attack.mitre.org/{attackTypeToUrlPath[obj_type]}/{external_id}"
+            }],
+            "x_mitre_version": "1.0"
+        }
+        if stix_type in ["malware", "tool"]:
+            obj["labels"] = [stix_type]
+        if obj_type == "technique":
+            obj["kill_chain_phases"] = [{"kill_chain_name": domainToSourceName[domain], "phase_name": self.random.choice(domainToTactics[domain])}]
+            obj["x_mitre_platforms"] = ["Windows"]
+            obj["x_mitre_is_subtechnique"] = False
+        return obj
+
+
+    def relationship(self, relationship_type, source_ref, target_ref):
+        """
+        Create a relationship.
+        """
+        relationship = {
+            "type": "relationship",
+            "id": self.stix_id("relationship"),
+            "created": self.timestamp(0),
+            "modified": self.timestamp(0),
+            "relationship_type": relationship_type,
+            "source_ref": source_ref,
+            "target_ref": target_ref
+        }
+        if relationship_type != "subtechnique-of":
+            relationship["description"] = f"Synthetic {relationship_type} relationship."
+        return relationship
+
+
+    def techniques(self, domain, count, first_index=0):
+        """
+        Create count techniques, self.fractions["subtechniques"] of which are sub-techniques of the others.
+
+        Returns the techniques and their subtechnique-of relationships.
+        """
+        subtechnique_count = int(count * self.fractions["subtechniques"])
+        parents = [self.sdo(domain, "technique", 1000 + first_index + i) for i in range(max(count - subtechnique_count, 1))]
+        objects = list(parents)
+        relationships = []
+        subtechnique_counts = {} # parent stixID => number of sub-techniques
+        for i in range(subtechnique_count):
+            parent = self.random.choice(parents)
+            number = subtechnique_counts[parent["id"]] = subtechnique_counts.get(parent["id"], 0) + 1
+            parent_id = parent["external_references"][0]["external_id"]
+            subtechnique = self.sdo(domain, "technique", i, f"{parent_id}.{number:03d}", f"https://attack.mitre.org/techniques/{parent_id}/{number:03d}")
+            subtechnique["kill_chain_phases"] = parent["kill_chain_phases"]
+            subtechnique["x_mitre_is_subtechnique"] = True
+            objects.append(subtechnique)
+            relationships.append(self.relationship("subtechnique-of", subtechnique["id"], parent["id"]))
+        return objects, relationships
+
+
+    def old_bundle(self, domain):
+        """
+        Generate the objects of the old bundle of a domain, grouped by ATT&CK type, and its relationships.
+        """
+        counts = {key: int(count * self.scale) for key, count in domainToObjectCounts[domain].items()}
+        type_to_objects = {}
+        type_to_objects["technique"], relationships = self.techniques(domain, counts["technique"])
+        for obj_type in ["software", "group", "mitigation"]:
+            type_to_objects[obj_type] = [self.sdo(domain, obj_type, i) for i in range(counts[obj_type])]
+
+        techniques = type_to_objects["technique"]
+        users = type_to_objects["software"] + type_to_objects["group"]
+        for _ in range(counts["uses"]):
+            relationships.append(self.relationship("uses", self.random.choice(users)["id"], self.random.choice(techniques)["id"]))
+        for _ in range(counts["mitigates"]):
+            relationships.append(self.relationship("mitigates", self.random.choice(type_to_objects["mitigation"])["id"], self.random.choice(techniques)["id"]))
+        return type_to_objects, relationships
+
+
+    def new_bundle(self, domain, type_to_objects, relationships):
+        """
+        Generate the objects of the new bundle of a domain from the old bundle, according to self.fractions.
+        """
+        new_objects = []
+        new_relationships = list(relationships)
+        deleted = set()
+        for obj_type, objects in type_to_objects.items():
+            objects = [dict(obj) for obj in objects] # copies, so the old objects are left as they were
+            shuffled = list(objects)
+            self.random.shuffle(shuffled)
+            # take the objects of each section from the shuffled objects in turn
+            sections = {}
+            for section in ["changes", "minor_changes", "deprecations", "revocations", "deletions"]:
+                count = int(len(objects) * self.fractions[section])
+                sections[section], shuffled = shuffled[:count], shuffled[count:]
+
+            for obj in sections["changes"]:
+                obj["x_mitre_version"] = "1.1"
+                obj["modified"] = self.timestamp(60)
+                obj["description"] += " Changed."
+            for obj in sections["minor_changes"]:
+                obj["modified"] = self.timestamp(30)
+                obj["x_mitre_platforms"] = ["Windows", "Linux"]
+            for obj in sections["deprecations"]:
+                obj["x_mitre_deprecated"] = True
+            for obj in sections["revocations"]:
+                obj["revoked"] = True
+                # revoke by an object of the same type which isn't revoked, deprecated or deleted
+                if shuffled:
+                    new_relationships.append(self.relationship("revoked-by", obj["id"], self.random.choice(shuffled)["id"]))
+            deleted.update(obj["id"] for obj in sections["deletions"])
+            new_objects += [obj for obj in objects if obj["id"] not in deleted]
+
+            additions = int(len(objects) * self.fractions["additions"])
+            if obj_type == "technique":
+                added, added_relationships = self.techniques(domain, additions, first_index=len(objects))
+                new_objects += added
+                new_relationships += added_relationships
+            else:
+                new_objects += [self.sdo(domain, obj_type, len(objects) + i) for i in range(additions)]
+
+        new_relationships = [
+            relationship for relationship in new_relationships
+            if relationship["source_ref"] not in deleted and relationship["target_ref"] not in deleted
+        ]
+        return new_objects, new_relationships
+
+
+    def write(self, directory, domains=["enterprise-attack", "mobile-attack"]):
+        """
+        Write the old and new bundle of each domain to the 'old' and 'new' folders of a directory.
+
+        Returns the number of objects in the old bundles.
+        """
+        object_count = 0
+        for domain in domains:
+            type_to_objects, relationships = self.old_bundle(domain)
+            new_objects, new_relationships = self.new_bundle(domain, type_to_objects, relationships)
+            old_objects = [obj for objects in type_to_objects.values() for obj in objects] + relationships
+            object_count += len(old_objects)
+            for side, objects in [("old", old_objects), ("new", new_objects + new_relationships)]:
+                os.makedirs(os.path.join(directory, side), exist_ok=True)
+                with open(os.path.join(directory, side, domain + ".json"), "w", encoding="utf-8") as f:
+                    json.dump({"type": "bundle", "id": self.stix_id("bundle"), "spec_version": "2.0", "objects": objects}, f)
+        return object_count
+
+
+def run_phases(directory, **kwargs):
+    """
+    Run the phases of a diff of the bundles in a directory, returning the seconds each phase took.
+
+    The phases are load_data (run by the DiffStix constructor), get_markdown_string and get_layers_dict.
+    kwargs are passed on to DiffStix.
+    """
+    timings = {}
+    start = time.perf_counter()
+    diffStix = DiffStix(old=os.path.join(directory, "old"), new=os.path.join(directory, "new"), **kwargs)
+    timings["load_data"] = time.perf_counter() - start
+    start = time.perf_counter()
+    diffStix.get_markdown_string()
+    timings["get_markdown_string"] = time.perf_counter() - start
+    if "technique" in diffStix.types:
+        start = time.perf_counter()
+        diffStix.get_layers_dict()
+        timings["get_layers_dict"] = time.perf_counter() - start
+    return timings
+
+
+def trace_phases(directory, **kwargs):
+    """
+    Run the phases of a diff of the bundles in a directory under tracemalloc, returning the peak memory of each phase in bytes.
+
+    Memory still held from an earlier phase, such as the data loaded by load_data, counts towards the peak of later phases.
+    """
+    peaks = {}
+    tracemalloc.start()
+    try:
+        diffStix = DiffStix(old=os.path.join(directory, "old"), new=os.path.join(directory, "new"), **kwargs)
+        peaks["load_data"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        diffStix.get_markdown_string()
+        peaks["get_markdown_string"] = tracemalloc.get_traced_memory()[1]
+        if "technique" in diffStix.types:
+            tracemalloc.reset_peak()
+            diffStix.get_layers_dict()
+            peaks["get_layers_dict"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def benchmark(scales, fractions=fractionDefaults, seed=0, repeat=3, data_dir=None, verbose=False, **kwargs):
+    """
+    Benchmark DiffStix against generated bundles at each scale.
+
+    params:
+        scales: list of multipliers for the object counts in domainToObjectCounts, e.g. [1, 10, 100]
+        fractions: passed on to BundleGenerator
+        seed: passed on to BundleGenerator
+        repeat: number of times to time each scale. The fastest time of each phase is reported
+        data_dir: if set, write the generated bundles to a folder per scale in this directory and keep them.
+            Otherwise they are written to a temporary directory and deleted
+        verbose: if true, print a line for each scale as it is benchmarked
+        kwargs: passed on to DiffStix, e.g. types, minor_changes, low_memory
+
+    returns a list with a dict of the scale, object count, seconds and peak memory of each phase for each scale
+    """
+    results = []
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            directory = os.path.join(data_dir, f"{scale}x") if data_dir else tmpdir
+            start = time.perf_counter()
+            object_count = BundleGenerator(scale, fractions, seed).write(directory, kwargs.get("domains", ["enterprise-attack", "mobile-attack"]))
+            if verbose:
+                print(f"{scale}x: generated {object_count} objects in {time.perf_counter() - start:.1f}s")
+
+            runs = [run_phases(directory, **kwargs) for _ in range(repeat)]
+            seconds = {phase: min(run[phase] for run in runs) for phase in runs[0]}
+            peaks = trace_phases(directory, **kwargs)
+        results.append({
+            "scale": scale,
+            "objects": object_count,
+            "seconds": seconds,
+            "peak_memory": peaks
+        })
+        if verbose:
+            print(f"{scale}x: " + ", ".join(f"{phase} {seconds[phase]:.3f}s {peaks[phase] / 2**20:.1f}MiB" for phase in seconds))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark diff_stix.py against generated enterprise and mobile shaped bundles at several scales. Times load_data, get_markdown_string and get_layers_dict and records the peak memory of each."
+    )
+    parser.add_argument("-scales",
+        type=float,
+        nargs="+",
+        metavar="SCALE",
+        default=[1, 10, 100],
+        help="multipliers for the number of objects and relationships in the current ATT&CK content to benchmark. Defaults are %(default)s"
+    )
+    for section, default in fractionDefaults.items():
+        parser.add_argument(f"-{section}",
+            type=float,
+            metavar="FRACTION",
+            default=default,
+            help="fraction of the techniques which are sub-techniques. Default is %(default)s" if section == "subtechniques" else f"fraction of the objects of each type in the {section.replace('_', ' ')} section. Default is %(default)s"
+        )
+    parser.add_argument("-seed",
+        type=int,
+        default=0,
+        help="seed for generating the bundles. Default is %(default)s"
+    )
+    parser.add_argument("-repeat",
+        type=int,
+        default=3,
+        help="number of times to time each scale; the fastest time is reported. Default is %(default)s"
+    )
+    parser.add_argument("-types",
+        type=str,
+        nargs="+",
+        metavar="OBJ_TYPE",
+        choices=["technique", "software", "group", "mitigation", "relationship"],
+        default=["technique", "software", "group", "mitigation"],
+        help="which types of objects to diff. Choices are %(choices)s. Defaults are %(default)s"
+    )
+    parser.add_argument("-data_dir",
+        type=str,
+        help="keep the generated bundles in this directory, in a folder per scale"
+    )
+    parser.add_argument("-output",
+        type=str,
+        metavar="OUTFILE",
+        help="write the results to a JSON file"
+    )
+    parser.add_argument("--minor-changes",
+        action="store_true",
+        help="diff with minor changes reported"
+    )
+    parser.add_argument("--unchanged",
+        action="store_true",
+        help="diff with unchanged objects reported"
+    )
+    parser.add_argument("--low-memory",
+        action="store_true",
+        help="benchmark the low-memory mode of diff_stix.py"
+    )
+    args = parser.parse_args()
+
+    results = benchmark(
+        [int(scale) if float(scale).is_integer() else scale for scale in args.scales],
+        fractions={section: getattr(args, section) for section in fractionDefaults},
+        seed=args.seed,
+        repeat=args.repeat,
+        data_dir=args.data_dir,
+        verbose=True,
+        types=args.types,
+        minor_changes=args.minor_changes,
+        unchanged=args.unchanged,
+        low_memory=args.low_memory
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -1,35 +1,50 @@
 import argparse
-from stix2 import MemoryStore, Filter, TAXIICollectionSource
+import codecs
+import contextlib
+import functools
+import hashlib
+import heapq
+import tempfile
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from stix2 import MemoryStore, Filter
 from taxii2client.v20 import Collection
 import os
+import io
 import json
+import re
 from tqdm import tqdm
 import datetime
 from string import Template
-from itertools import chain
 from dateutil import parser as dateparser
+from requests.exceptions import HTTPError
 
 # helper maps
 domainToDomainLabel = {
     'enterprise-attack': 'Enterprise', 
     'mobile-attack': 'Mobile'
 }
+taxiiCollectionsUrl = "https://cti-taxii.mitre.org/stix/collections/"
 domainToTaxiiCollectionId = {
     "enterprise-attack": "95ecc380-afe9-11e4-9b6c-751b66dd541e",
     "mobile-attack": "2f669986-b40b-4423-b720-4396ca6a462b",
 }
-attackTypeToStixFilter = { # stix filters for querying for each type of data
-    'technique': [Filter('type', '=', 'attack-pattern')],
-    'software': [Filter('type', '=', 'malware'), Filter('type', '=', 'tool')],
-    'group': [Filter('type', '=', 'intrusion-set')],
-    'mitigation': [Filter('type', '=', 'course-of-action')]
+attackTypeToStixTypes = { # stix types of the objects for each type of data
+    'technique': ['attack-pattern'],
+    'software': ['malware', 'tool'],
+    'group': ['intrusion-set'],
+    'mitigation': ['course-of-action'],
+    'relationship': ['relationship']
 }
 attackTypeToPlural = { # because some of these pluralize differently
     'technique': 'techniques',
     'malware': 'malware',
     'software': 'software',
     'group': 'groups',
-    'mitigation': 'mitigations'
+    'mitigation': 'mitigations',
+    'relationship': 'relationships'
 }
 sectionNameToSectionHeaders = { # how we want to format headers for each section
     "additions": "New {obj_type}",
@@ -40,6 +55,27 @@ sectionNameToSectionHeaders = { # how we want to format headers for each section
     "deletions": "{obj_type} deletions",
     "unchanged": "Unchanged {obj_type}"
 }
+fieldChangesIgnoredFields = { # fields which aren't reported as field changes, because they change with every edit or are added by DiffStix
+    "created",
+    "modified",
+    "x_mitre_version",
+    "revoked_by",
+    "changed_fields"
+}
+summaryFields = [ # fields of each object kept in the bundle cache, which are all the diff needs to classify objects
+    "id",
+    "type",
+    "name",
+    "modified",
+    "x_mitre_version",
+    "revoked",
+    "x_mitre_deprecated",
+    "x_mitre_is_subtechnique",
+    "relationship_type",
+    "source_ref",
+    "target_ref"
+]
+bundleCacheVersion = 1 # increment when the format of bundle cache files changes
 statusToColor = { # color key for layers
     "additions": "#a1d99b",
     "changes": "#fcf3a2",
@@ -59,6 +95,319 @@ statusDescriptions = { # explanation of modification types to data objects for l
     "unchanged": "objects which did not change between the two versions"
 }
 
+def parse_timestamp(value):
+    """
+    Parse a STIX timestamp into a datetime.
+
+    Handles datetimes, the strings produced by str() on a datetime, and ISO-8601 strings ending in 'Z' natively.
+    Falls back to dateutil only for values the standard library can't parse.
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        if value.endswith("Z"):
+            return datetime.datetime.fromisoformat(value[:-1] + "+00:00")
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return dateparser.parse(value)
+
+
+def hash_fields(obj):
+    """
+    Return a dict mapping each field of a stix object to a hash of its content.
+
+    Values are hashed from their canonical JSON serialization so that nested lists and dicts compare structurally.
+    """
+    return {
+        field: hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode("utf-8"), digest_size=8).digest()
+        for field, value in obj.items() if field not in fieldChangesIgnoredFields
+    }
+
+
+def content_hash(obj):
+    """
+    Return a hash of the content of a stix object, ignoring the fields in fieldChangesIgnoredFields.
+    """
+    content = {field: value for field, value in obj.items() if field not in fieldChangesIgnoredFields}
+    return hashlib.blake2b(json.dumps(content, sort_keys=True, default=str).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def description_hash(relationship):
+    """
+    Return a hash of the description of a relationship, or of its summary in the bundle cache.
+    """
+    if "description_hash" in relationship:
+        return relationship["description_hash"]
+    if "description" not in relationship:
+        return None
+    return hashlib.blake2b(relationship["description"].encode("utf-8"), digest_size=8).hexdigest()
+
+
+def fetch_taxii_objects(collection, per_request=1000, workers=4, added_after=None):
+    """
+    Fetch every object of a TAXII 2.0 collection, optionally only those added after the added_after timestamp.
+
+    The first page says how many objects the collection has in its Content-Range header, and the remaining pages are
+    then fetched concurrently by workers threads. Servers may return fewer than per_request objects per page, so the
+    pages are as long as the first one was, and any page which still comes back short is completed from where it
+    stopped. If the server doesn't say how many objects there are, pages are fetched one after another until one comes
+    back empty or the server answers 416 Range Not Satisfiable.
+    """
+    filters = {"added_after": added_after} if added_after else {}
+    def page(start, count=per_request):
+        response = collection.get_objects(start=start, per_request=count, **filters)
+        return response.json().get("objects", []), response.headers.get("Content-Range", "")
+
+    def span(start, end):
+        # fetch the objects from start up to end, in as many requests as the server needs
+        span_objects = []
+        while start + len(span_objects) < end:
+            page_objects, _ = page(start + len(span_objects), min(per_request, end - start - len(span_objects)))
+            if not page_objects: break
+            span_objects += page_objects
+        return span_objects
+
+    objects, content_range = page(0)
+    total = re.match(r"^items \d+-\d+/(\d+)$", content_range)
+    total = int(total.group(1)) if total else None
+    if total is not None and objects:
+        stride = len(objects)
+        starts = range(stride, total, stride)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for span_objects in executor.map(lambda start: span(start, min(start + stride, total)), starts):
+                objects += span_objects
+    else:
+        page_objects = objects
+        while page_objects:
+            try:
+                page_objects, _ = page(len(objects))
+            except HTTPError as e:
+                if e.response is None or e.response.status_code != 416: raise
+                break
+            objects += page_objects
+    if total is not None and len(objects) != total:
+        raise RuntimeError(f"the TAXII server returned {len(objects)} of the {total} objects of the collection")
+    return objects
+
+
+def attack_id(obj):
+    """
+    Return the ATT&CK ID of a stix object from its first external reference, or None if it doesn't have one.
+    """
+    if obj.get("external_references") and "external_id" in obj["external_references"][0]:
+        return obj["external_references"][0]["external_id"]
+    return None
+
+
+def summarize_stix(obj, with_content_hash=True):
+    """
+    Return the summary of a stix object stored in the bundle cache.
+
+    The summary keeps the summaryFields, the external ID, a hash of the content unless with_content_hash is false and,
+    for relationships, a hash of the description.
+    """
+    summary = {field: obj[field] for field in summaryFields if field in obj}
+    if attack_id(obj):
+        summary["external_references"] = [{"external_id": attack_id(obj)}]
+    if obj["type"] == "relationship":
+        summary["description_hash"] = description_hash(obj)
+    if with_content_hash:
+        summary["content_hash"] = content_hash(obj)
+    return summary
+
+
+def scan_bundle(text):
+    """
+    Yield (object, start, end) for each object in the "objects" array of the JSON text of a bundle.
+
+    start and end are the character offsets of the object in text.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"[ \t\n\r]*")
+    number_tail = re.compile(r"[0-9.eE+-]*") # characters which can continue a number
+    def skip(idx, separator=None):
+        # skip whitespace, and the given separator and the whitespace after it if it's next
+        idx = whitespace.match(text, idx).end()
+        if separator and text.startswith(separator, idx):
+            idx = whitespace.match(text, idx + 1).end()
+        return idx
+
+    idx = skip(0)
+    if not text.startswith("{", idx):
+        raise ValueError("bundle is not a JSON object")
+    idx = skip(idx + 1)
+    while not text.startswith("}", idx):
+        key, idx = decoder.raw_decode(text, idx)
+        idx = skip(idx, ":")
+        if key == "objects":
+            idx = skip(idx + 1) # skip the opening bracket
+            while not text.startswith("]", idx):
+                obj, end = decoder.raw_decode(text, idx)
+                yield obj, idx, end
+                idx = skip(end, ",")
+            idx += 1
+        else:
+            _, idx = decoder.raw_decode(text, idx)
+        idx = skip(idx, ",")
+
+
+def stream_bundle(path, chunk_size=1 << 20):
+    """
+    Yield (object, start, end) for each object in the "objects" array of a bundle file, reading it chunk_size bytes at a time.
+
+    start and end are the byte offsets of the object in the file. Only the object being decoded and the unread rest of
+    the current chunk are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r"[ \t\n\r]*")
+    number_tail = re.compile(r"[0-9.eE+-]*") # characters which can continue a number
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""       # decoded text of the file from the current position on
+    pos = 0        # index of the current position in buf
+    offset = 0     # byte offset of the current position in the file
+    eof = False    # whether the whole file has been read into buf
+
+    with open(path, "rb") as f:
+        def fill():
+            # append the next chunk of the file to buf, returning false at the end of the file
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            buf = buf[pos:] + utf8.decode(chunk, final=not chunk)
+            pos = 0
+            eof = not chunk
+            return bool(chunk)
+
+        def advance(idx):
+            nonlocal pos, offset
+            offset += len(buf[pos:idx].encode("utf-8"))
+            pos = idx
+
+        def skip(separator=None):
+            # skip whitespace, and the given separator and the whitespace after it if it's next
+            while True:
+                advance(whitespace.match(buf, pos).end())
+                if pos < len(buf) or not fill(): break
+            if separator and buf.startswith(separator, pos):
+                advance(pos + 1)
+                skip()
+
+        def decode():
+            # decode the value at the current position, reading more of the file until it's complete
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if fill(): continue
+                    raise
+                # a number which runs up to the end of buf may continue in the next chunk
+                if isinstance(value, (int, float)) and not eof and number_tail.match(buf, end).end() == len(buf) and fill(): continue
+                advance(end)
+                return value
+
+        skip()
+        if not buf.startswith("{", pos):
+            raise ValueError("bundle is not a JSON object")
+        advance(pos + 1)
+        skip()
+        while not buf.startswith("}", pos):
+            key = decode()
+            skip(":")
+            if key == "objects":
+                advance(pos + 1) # skip the opening bracket
+                skip()
+                while not buf.startswith("]", pos):
+                    start = offset
+                    obj = decode()
+                    yield obj, start, offset
+                    skip(",")
+                advance(pos + 1)
+            else:
+                decode()
+            skip(",")
+
+
+def sort_records(records, tmpdir, run_size):
+    """
+    Sort (key, ...) records by key with an external merge sort, holding at most run_size records in memory.
+
+    Records are written to tmpdir in sorted runs of run_size records, which are merged lazily. If the records fit in
+    a single run nothing is written. Returns an iterator over the sorted records, which are lists.
+    """
+    def write_run(run):
+        run.sort(key=lambda record: record[0])
+        fd, path = tempfile.mkstemp(suffix=".ndjson", dir=tmpdir)
+        with open(fd, "w", encoding="utf-8") as f:
+            for record in run:
+                f.write(json.dumps(record) + "\n")
+        return path
+
+    def read_run(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    runs = []
+    run = []
+    for record in records:
+        run.append(list(record))
+        if len(run) >= run_size:
+            runs.append(write_run(run))
+            run = []
+    if not runs:
+        run.sort(key=lambda record: record[0])
+        return iter(run)
+    if run:
+        runs.append(write_run(run))
+    # heapq.merge is stable, so records with the same key stay in the order they were read
+    return heapq.merge(*[read_run(path) for path in runs], key=lambda record: record[0])
+
+
+def merge_join(old, new):
+    """
+    Yield (old record, new record) for each key of two iterators of records sorted by key.
+
+    Either record is None if its iterator has no record with the key. If an iterator has several records with the same
+    key, the last one is used.
+    """
+    def unique(records):
+        last = None
+        for record in records:
+            if last is not None and record[0] != last[0]:
+                yield last
+            last = record
+        if last is not None:
+            yield last
+
+    old = unique(old)
+    new = unique(new)
+    old_record = next(old, None)
+    new_record = next(new, None)
+    while old_record is not None or new_record is not None:
+        if new_record is None or (old_record is not None and old_record[0] < new_record[0]):
+            yield old_record, None
+            old_record = next(old, None)
+        elif old_record is None or new_record[0] < old_record[0]:
+            yield None, new_record
+            new_record = next(new, None)
+        else:
+            yield old_record, new_record
+            old_record = next(old, None)
+            new_record = next(new, None)
+
+
+def timed_phase(phase):
+    """
+    Decorate a DiffStix method so that each call is timed as the given phase, see DiffStix.timed.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def timed_method(self, *args, **kwargs):
+            with self.timed(phase):
+                return method(self, *args, **kwargs)
+        return timed_method
+    return decorator
+
+
 class DiffStix(object):
     """
     Utilities for detecting and summarizing differences between two versions of the ATT&CK content.
@@ -76,6 +425,16 @@ class DiffStix(object):
         site_prefix='',
         types=['technique', 'software', 'group', 'mitigation'],
         use_taxii=False,
+        taxii_added_after=None,
+        refresh_taxii=False,
+        strict=False,
+        jobs=1,
+        field_changes=False,
+        loaded_bundles=None,
+        cache_dir=None,
+        low_memory=False,
+        run_size=100000,
+        metrics=False,
         verbose=False
     ):
         """
@@ -90,7 +449,26 @@ class DiffStix(object):
             old: directory to load for old stix version
             show_key: if true, output key to markdown file
             site_prefix: prefix links in markdown output
-            types: which types of objects to report on, e.g technique, software
+            types: which types of objects to report on, e.g technique, software, relationship
+            use_taxii: if true, load the old stix version from the ATT&CK TAXII server
+            taxii_added_after: with use_taxii, only load the objects added to the TAXII collections after this timestamp
+            refresh_taxii: with use_taxii and cache_dir, fetch the TAXII collections again even if they are already in the cache
+            strict: if true, validate bundles loaded from directories by parsing them with the stix2 library
+            jobs: number of processes to load the old and new bundles of each domain with. 1 loads them sequentially
+            field_changes: if true, find which fields changed for each changed object and list them in the markdown output
+            loaded_bundles: optional dict of (directory, domain) => loaded bundle, shared between DiffStix objects so that
+                each bundle in a directory is only parsed once. Bundles loaded by this object are added to it
+            cache_dir: optional directory for a cache of each directory bundle's object summaries. Bundles which haven't
+                changed since they were cached are diffed from the cache, and only the objects in the output are parsed.
+                Not used if strict is true. With use_taxii, the fetched TAXII collections are also kept here, and are
+                loaded from the cache instead of fetched again unless refresh_taxii is true
+            low_memory: if true, stream the bundles from the old and new directories and diff them with a sort-merge
+                join instead of loading them, so that memory use is bounded by run_size and the size of the output.
+                Not supported with use_taxii or the relationship type, and strict, jobs, loaded_bundles and cache_dir are ignored
+            run_size: with low_memory, the number of object summaries to sort in memory before spilling them to disk
+            metrics: if true, trace memory allocations with tracemalloc so that get_metrics_dict can report peak memory.
+                The tracing runs until get_metrics_dict is called, and isn't inherited by the jobs processes. Phase timings
+                and object counts are always collected
             verbose: if true, print progress bar and status messages to stdout
         """
         self.domains = domains
@@ -104,6 +482,16 @@ class DiffStix(object):
         self.site_prefix = site_prefix
         self.types = types
         self.use_taxii = use_taxii
+        self.taxii_added_after = taxii_added_after
+        self.refresh_taxii = refresh_taxii
+        self.strict = strict
+        self.jobs = jobs
+        self.field_changes = field_changes
+        self.loaded_bundles = loaded_bundles
+        self.cache_dir = cache_dir
+        self.low_memory = low_memory
+        self.run_size = run_size
+        self.metrics = metrics
         self.verbose = verbose
 
         self.data = {   # data gets load into here in the load() function. All other functionalities rely on this data structure
@@ -122,15 +510,31 @@ class DiffStix(object):
             # software...
         }
         self.stixIDToName = {} # stixID to object name
-        self.new_subtechnique_of_rels = [] # all subtechnique-of relationships in the new data
-        self.old_subtechnique_of_rels = [] # all subtechnique-of relationships in the old data
+        self.new_subtechnique_of_rels = {} # (source_ref, target_ref) => relationship for all subtechnique-of relationships in the new data
+        self.old_subtechnique_of_rels = {} # (source_ref, target_ref) => relationship for all subtechnique-of relationships in the old data
+        self.new_parent_to_children = {} # parent stixID => [ child stixIDs ] in the new data
+        self.old_parent_to_children = {} # parent stixID => [ child stixIDs ] in the old data
+        self.new_child_to_parent = {} # child stixID => parent stixID in the new data
+        self.old_child_to_parent = {} # child stixID => parent stixID in the old data
         self.new_id_to_technique = {} # stixID => technique for every technique in the new data
         self.old_id_to_technique = {} # stixID => technique for every technique in the old data
-        # build the bove data structures
+        self.old_versions = {} # (domain, stixID) => old version of each reported object which is in both the old and new data
+        self.phase_seconds = {} # phase => wall time spent in it, see timed
+        self.phase_stack = [] # [phase, start time] of the phases being timed, innermost last
+        self.counts = {} # type => domain => 'old' or 'new' => number of objects
+        self.peak_memory = None # peak traced memory in bytes, see get_metrics_dict
+        self.tracing = self.metrics and not tracemalloc.is_tracing() # whether this object started tracemalloc
+        if self.tracing:
+            tracemalloc.start()
+        # build the above data structures
         self.load_data()
-        # remove duplicate relationships
-        self.new_subtechnique_of_rels = [i for n, i in enumerate(self.new_subtechnique_of_rels) if i not in self.new_subtechnique_of_rels[n+1:]]
-        self.old_subtechnique_of_rels = [i for n, i in enumerate(self.old_subtechnique_of_rels) if i not in self.old_subtechnique_of_rels[n+1:]]
+
+
+    def __getstate__(self):
+        # loaded bundles shared with other diffs aren't needed to load a bundle in another process
+        state = self.__dict__.copy()
+        state["loaded_bundles"] = None
+        return state
 
 
     def verboseprint(self, *args, **kwargs):
@@ -138,6 +542,28 @@ class DiffStix(object):
             print(*args, **kwargs)
 
 
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """
+        Add the wall time spent in the with block to the given phase in self.phase_seconds.
+
+        Phases can be nested, in which case the time spent in the inner phase only counts towards the inner phase.
+        """
+        now = time.perf_counter()
+        if self.phase_stack:
+            outer = self.phase_stack[-1]
+            self.phase_seconds[outer[0]] = self.phase_seconds.get(outer[0], 0) + now - outer[1]
+        self.phase_stack.append([phase, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            _, start = self.phase_stack.pop()
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + now - start
+            if self.phase_stack:
+                self.phase_stack[-1][1] = now
+
+
     def getUrlFromStix(self, datum, is_subtechnique=False):
         """
         Parse the website url from a stix object.
@@ -149,6 +575,7 @@ class DiffStix(object):
         return link
 
 
+    @timed_phase("deep_copy")
     def deep_copy_stix(self, objects):
         """
         Transform stix to dict and deep copy the dict.
@@ -172,150 +599,627 @@ class DiffStix(object):
         return result
 
 
+    def parse_subtechniques(self, loaded, new=False):
+        """
+        Add the techniques and sub-technique-of relationships of a loaded bundle to the new or old indexes.
+
+        Relationships are deduplicated by (source_ref, target_ref) and indexed parent => children and child => parent.
+        """
+        if new:
+            id_to_technique = self.new_id_to_technique
+            subtechnique_of_rels = self.new_subtechnique_of_rels
+            parent_to_children = self.new_parent_to_children
+            child_to_parent = self.new_child_to_parent
+        else:
+            id_to_technique = self.old_id_to_technique
+            subtechnique_of_rels = self.old_subtechnique_of_rels
+            parent_to_children = self.old_parent_to_children
+            child_to_parent = self.old_child_to_parent
+        for technique in loaded["techniques"]:
+            id_to_technique[technique["id"]] = technique
+        for relationship in loaded["subtechnique_of_rels"]:
+            key = (relationship["source_ref"], relationship["target_ref"])
+            if key in subtechnique_of_rels: continue # duplicate relationship
+            subtechnique_of_rels[key] = relationship
+            parent_to_children.setdefault(relationship["target_ref"], []).append(relationship["source_ref"])
+            child_to_parent.setdefault(relationship["source_ref"], relationship["target_ref"])
+
+
+    def load_objects(self, stix_type_to_objects):
+        """
+        Build the loaded view of a bundle from its objects grouped by stix type.
+
+        Returns a dict with:
+            id_to_obj: obj_type => (stixID => object) for each of self.types
+            revoked_by: revoked stixID => revoking stixID, from the revoked-by relationships
+            techniques: every technique in the bundle
+            subtechnique_of_rels: every subtechnique-of relationship in the bundle
+            id_to_named: stixID => object for every object with a name, only when reporting on relationships
+            relationship_count: the number of relationships in the bundle
+
+        The objects can be summaries from the bundle cache, in which case the view also has the bundle_path and offsets
+        to read the full objects with, see materialize.
+        """
+        revoked_by = {}
+        subtechnique_of_rels = []
+        for relationship in stix_type_to_objects.get("relationship", []):
+            if relationship["relationship_type"] == "revoked-by":
+                revoked_by.setdefault(relationship["source_ref"], relationship["target_ref"])
+            elif relationship["relationship_type"] == "subtechnique-of":
+                subtechnique_of_rels.append(relationship)
+        id_to_obj = {}
+        for obj_type in self.types:
+            id_to_obj[obj_type] = {
+                item['id']: item for stix_type in attackTypeToStixTypes[obj_type] for item in stix_type_to_objects.get(stix_type, [])
+            }
+
+        return {
+            "id_to_obj": id_to_obj,
+            "revoked_by": revoked_by,
+            "techniques": stix_type_to_objects.get("attack-pattern", []),
+            "subtechnique_of_rels": subtechnique_of_rels,
+            "relationship_count": len(stix_type_to_objects.get("relationship", [])),
+            "id_to_named": {
+                item["id"]: item for items in stix_type_to_objects.values() for item in items if "name" in item
+            } if "relationship" in self.types else {}
+        }
+
+
+    def load_datastore(self, data_store):
+        """
+        Query a stix2 data store once for each ATT&CK stix type and build its loaded view.
+        """
+        stix_types = dict.fromkeys(stix_type for stix_types in attackTypeToStixTypes.values() for stix_type in stix_types)
+        stix_type_to_objects = {
+            stix_type: self.deep_copy_stix(data_store.query([Filter("type", "=", stix_type)])) for stix_type in stix_types
+        }
+        return self.load_objects(stix_type_to_objects)
+
+
+    def load_bundle(self, datafile):
+        """
+        Read a bundle file straight into dicts grouped by stix type and build its loaded view.
+
+        Skips constructing (and validating) stix2 objects, which is much faster and lighter on memory.
+        """
+        with open(datafile, encoding="utf-8") as f:
+            bundle = json.load(f)
+        stix_type_to_objects = {}
+        for obj in bundle["objects"]:
+            stix_type_to_objects.setdefault(obj["type"], []).append(obj)
+        return self.load_objects(stix_type_to_objects)
+
+
+    def load_dir(self, dir, domain):
+        """
+        Load the bundle for the given domain from a directory.
+        """
+        datafile = os.path.join(dir, domain + ".json")
+        if self.strict:
+            data_store = MemoryStore()
+            data_store.load_from_file(datafile)
+            return self.load_datastore(data_store)
+        if self.cache_dir:
+            return self.load_cached_bundle(datafile)
+        return self.load_bundle(datafile)
+
+
+    def load_cached_bundle(self, datafile):
+        """
+        Load a bundle file through the bundle cache in self.cache_dir.
+
+        The cache stores, for each bundle file, the summary of every ATT&CK object and its byte offsets in the file,
+        along with the file's size, modification time and hash. If the file hasn't changed, its loaded view is built
+        from the summaries alone. Otherwise the file is parsed in full and its cache is rebuilt.
+        """
+        cache_file = os.path.join(self.cache_dir, hashlib.sha1(os.path.abspath(datafile).encode("utf-8")).hexdigest() + ".json")
+        stat = os.stat(datafile)
+        cache = None
+        if os.path.exists(cache_file):
+            with open(cache_file, encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache["version"] != bundleCacheVersion or cache["size"] != stat.st_size:
+                cache = None
+            elif cache["mtime"] != stat.st_mtime:
+                # the file was touched; it's only changed if its content has
+                with open(datafile, "rb") as f:
+                    if hashlib.sha256(f.read()).hexdigest() != cache["sha256"]:
+                        cache = None
+                    else:
+                        # save the new modification time, so the file isn't hashed again on every later run
+                        cache["mtime"] = stat.st_mtime
+                        self.write_bundle_cache(cache_file, cache)
+        if cache is None:
+            return self.build_bundle_cache(datafile, cache_file, stat)
+
+        stix_type_to_objects = {}
+        offsets = {}
+        for start, end, summary in cache["objects"]:
+            stix_type_to_objects.setdefault(summary["type"], []).append(summary)
+            offsets[summary["id"]] = (start, end)
+        loaded = self.load_objects(stix_type_to_objects)
+        loaded["bundle_path"] = datafile
+        loaded["offsets"] = offsets
+        loaded["materialized"] = {} # stixID => full object, for objects read from the bundle file so far
+        return loaded
+
+
+    def build_bundle_cache(self, datafile, cache_file, stat):
+        """
+        Parse a bundle file in full, write its cache file and return its loaded view.
+        """
+        with open(datafile, "rb") as f:
+            raw = f.read()
+        text = raw.decode("utf-8")
+        ascii_only = len(text) == len(raw) # character offsets are byte offsets
+
+        stix_type_to_objects = {}
+        cached_objects = []
+        stix_types = set(stix_type for stix_types in attackTypeToStixTypes.values() for stix_type in stix_types)
+        last_char, last_byte = 0, 0
+        for obj, start, end in scan_bundle(text):
+            stix_type_to_objects.setdefault(obj["type"], []).append(obj)
+            if obj["type"] not in stix_types: continue
+            if not ascii_only:
+                # convert character offsets to byte offsets, encoding only the text since the last object
+                byte_start = last_byte + len(text[last_char:start].encode("utf-8"))
+                byte_end = byte_start + len(text[start:end].encode("utf-8"))
+                last_char, last_byte = end, byte_end
+                start, end = byte_start, byte_end
+            cached_objects.append([start, end, summarize_stix(obj)])
+
+        self.write_bundle_cache(cache_file, {
+            "version": bundleCacheVersion,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha256": hashlib.sha256(raw).hexdigest(),
+            "objects": cached_objects
+        })
+        return self.load_objects(stix_type_to_objects)
+
+
+    def write_bundle_cache(self, cache_file, cache):
+        """
+        Write the cache of a bundle file to cache_file in self.cache_dir.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write to a temporary file first, so an interrupted write never leaves a partial cache
+        with open(cache_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(cache_file + ".tmp", cache_file)
+
+
+    def materialize(self, loaded, obj):
+        """
+        Return the full object for an object of a loaded bundle.
+
+        Objects of bundles loaded from the bundle cache are summaries; their full object is read from the bundle file
+        the first time it's needed.
+        """
+        if "offsets" not in loaded:
+            return obj
+        if obj["id"] not in loaded["materialized"]:
+            start, end = loaded["offsets"][obj["id"]]
+            with open(loaded["bundle_path"], "rb") as f:
+                f.seek(start)
+                loaded["materialized"][obj["id"]] = json.loads(f.read(end - start).decode("utf-8"))
+        return loaded["materialized"][obj["id"]]
+
+
+    def load_taxii(self, domain):
+        """
+        Load the collection for the given domain from the TAXII server.
+
+        The collection is fetched once with fetch_taxii_objects. If self.cache_dir is set the fetched objects are written
+        to it as a bundle file, keyed by collection ID and self.taxii_added_after, and later runs load that bundle through
+        the bundle cache instead of fetching the collection again, with a warning since the server's content may have
+        changed since. If self.refresh_taxii is set the collection is always fetched and the snapshot replaced.
+        """
+        collection_id = domainToTaxiiCollectionId[domain]
+        fetch = lambda: fetch_taxii_objects(Collection(taxiiCollectionsUrl + collection_id + "/"), added_after=self.taxii_added_after)
+        if self.cache_dir and not self.strict:
+            added_after_key = hashlib.sha1(str(self.taxii_added_after).encode("utf-8")).hexdigest()
+            snapshot = os.path.join(self.cache_dir, f"taxii-{collection_id}-{added_after_key}.json")
+            if os.path.exists(snapshot) and not self.refresh_taxii:
+                fetched = datetime.datetime.fromtimestamp(os.path.getmtime(snapshot)).strftime("%Y-%m-%d %H:%M")
+                print(f"WARNING: using the {domain} TAXII content cached on {fetched} in {snapshot}. Use --refresh-taxii to fetch the current content")
+            else:
+                objects = fetch()
+                os.makedirs(self.cache_dir, exist_ok=True)
+                # write to a temporary file first, so an interrupted fetch never leaves a partial snapshot
+                with open(snapshot + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump({"type": "bundle", "id": f"bundle--{uuid.uuid4()}", "spec_version": "2.0", "objects": objects}, f)
+                os.replace(snapshot + ".tmp", snapshot)
+            return self.load_cached_bundle(snapshot)
+
+        objects = fetch()
+        if self.strict:
+            return self.load_datastore(MemoryStore(stix_data=objects))
+        stix_type_to_objects = {}
+        for obj in objects:
+            stix_type_to_objects.setdefault(obj["type"], []).append(obj)
+        return self.load_objects(stix_type_to_objects)
+
+
+    @timed_phase("parse")
+    def load_side(self, side, domain):
+        """
+        Load the 'old' or 'new' bundle for the given domain from either a directory or the TAXII server.
+        """
+        if side == "old":
+            if self.use_taxii:
+                return self.load_taxii(domain)
+            return self.load_dir(self.old, domain)
+        return self.load_dir(self.new, domain)
+
+
+    def loaded_bundle_key(self, side, domain):
+        """
+        Return the key of the 'old' or 'new' bundle for the given domain in loaded_bundles, or None if it isn't loaded from a directory.
+        """
+        if side == "old":
+            if self.use_taxii:
+                return None
+            return (self.old, domain)
+        return (self.new, domain)
+
+
     # load data into data structure
     def load_data(self):
         """
         Load data from files into data dict.
+
+        Each (side, domain) bundle is parsed once and the diff for every type runs against its type-partitioned view.
+        If self.jobs is greater than 1 the bundles are parsed concurrently in a process pool. The diffs still run in
+        domain order, so the result is the same as loading sequentially. Bundles found in self.loaded_bundles aren't parsed again.
         """
+        if self.low_memory:
+            return self.load_data_streaming()
         if self.verbose:
             pbar = tqdm(total=len(self.types) * len(self.domains), desc="loading data", bar_format="{l_bar}{bar}| [{elapsed}<{remaining}, {rate_fmt}{postfix}]")
-        for obj_type in self.types:
-            for domain in self.domains:
-                # handle data loaded from either a directory or the TAXII server
-                def load_datastore(data_store):
-                    raw_data = list(chain.from_iterable(
-                        data_store.query(f) for f in attackTypeToStixFilter[obj_type]
-                    ))
-                    raw_data = self.deep_copy_stix(raw_data)
-                    id_to_obj = {item['id']: item for item in raw_data}
-
-                    return {
-                        "id_to_obj": id_to_obj,
-                        "keys": set(id_to_obj.keys()),
-                        "data_store": data_store
-                    }
-
-                def parse_subtechniques(data_store, new=False):
-                    # parse dataStore sub-technique-of relationships
-                    if new: 
-                        for technique in list(data_store.query(attackTypeToStixFilter["technique"])):
-                            self.new_id_to_technique[technique["id"]] = technique
-                        self.new_subtechnique_of_rels += list(data_store.query([
-                            Filter("type", "=", "relationship"),
-                            Filter("relationship_type", "=", "subtechnique-of")
-                        ]))
+        loaded = {} # (side, domain) => loaded view, for bundles which were already loaded or are loaded in parallel
+        sides = [(side, domain) for domain in self.domains for side in ("old", "new")]
+        if self.loaded_bundles is not None:
+            for side, domain in sides:
+                bundle_key = self.loaded_bundle_key(side, domain)
+                if bundle_key in self.loaded_bundles:
+                    loaded[(side, domain)] = self.loaded_bundles[bundle_key]
+        if self.jobs > 1:
+            to_load = [key for key in sides if key not in loaded]
+            if to_load:
+                # the parse time of each bundle is spent in another process, so time waiting for them instead
+                with self.timed("parse"), ProcessPoolExecutor(max_workers=min(self.jobs, len(to_load)), initializer=tracemalloc.stop) as executor:
+                    futures = {key: executor.submit(self.load_side, *key) for key in to_load}
+                    loaded.update({key: future.result() for key, future in futures.items()})
+        for domain in self.domains:
+            old = loaded.pop(("old", domain)) if ("old", domain) in loaded else self.load_side("old", domain)
+            new = loaded.pop(("new", domain)) if ("new", domain) in loaded else self.load_side("new", domain)
+            if self.loaded_bundles is not None:
+                for side, loaded_side in [("old", old), ("new", new)]:
+                    bundle_key = self.loaded_bundle_key(side, domain)
+                    if bundle_key is not None:
+                        self.loaded_bundles[bundle_key] = loaded_side
+            for side, loaded_side in [("old", old), ("new", new)]:
+                for obj_type in self.types:
+                    self.counts.setdefault(obj_type, {}).setdefault(domain, {})[side] = len(loaded_side["id_to_obj"][obj_type])
+                self.counts.setdefault("relationship", {}).setdefault(domain, {})[side] = loaded_side["relationship_count"]
+            self.parse_subtechniques(old, False)
+            self.parse_subtechniques(new, True)
+
+            for obj_type in self.types:
+                with self.timed("set_diff"):
+                    if obj_type == "relationship":
+                        self.diff_relationships(domain, old, new)
                     else:
-                        for technique in list(data_store.query(attackTypeToStixFilter["technique"])):
-                            self.old_id_to_technique[technique["id"]] = technique
-                        self.old_subtechnique_of_rels += list(data_store.query([
-                            Filter("type", "=", "relationship"),
-                            Filter("relationship_type", "=", "subtechnique-of")
-                        ]))
-
-                # load data from directory according to domain
-                def load_dir(dir, new=False):
-                    data_store = MemoryStore()
-                    datafile = os.path.join(dir, domain + ".json")
-                    data_store.load_from_file(datafile)
-                    parse_subtechniques(data_store, new)
-                    return load_datastore(data_store)
-
-                # load data from TAXII server according to domain
-                def load_taxii(new=False):
-                    collection = Collection("https://cti-taxii.mitre.org/stix/collections/" + domainToTaxiiCollectionId[domain])
-                    data_store = TAXIICollectionSource(collection)
-                    parse_subtechniques(data_store, new)
-                    return load_datastore(data_store)
-
-                if self.use_taxii:
-                    old = load_taxii(False)
-                else:
-                    old = load_dir(self.old, False)
-                new = load_dir(self.new, True)
-
-                intersection = old["keys"] & new["keys"]
-                additions = new["keys"] - old["keys"]
-                deletions = old["keys"] - new["keys"]
-
-                # sets to store the ids of objects for each section
-                changes = set()
-                minor_changes = set()
-                revocations = set()
-                deprecations = set()
-                unchanged = set()
-
-                # find changes, revocations and deprecations
-                for key in intersection:
-                    if "revoked" in new["id_to_obj"][key] and new["id_to_obj"][key]["revoked"]:
-                        if not "revoked" in old["id_to_obj"][key] or not old["id_to_obj"][key]["revoked"]: # if it was previously revoked, it's not a change
-                            # store the revoking object
-                            revoked_by_key = new["data_store"].query([
-                                Filter('type', '=', 'relationship'),
-                                Filter('relationship_type', '=', 'revoked-by'),
-                                Filter('source_ref', '=', key)
-                            ])
-                            if (len(revoked_by_key) == 0): 
-                                print("WARNING: revoked object", key, "has no revoked-by relationship")
-                                continue
-                            else: revoked_by_key = revoked_by_key[0]["target_ref"]
-
-                            new["id_to_obj"][key]["revoked_by"] = new["id_to_obj"][revoked_by_key]
-
-                            revocations.add(key)
-                        # else it was already revoked, and not a change; do nothing with it
-                    elif "x_mitre_deprecated" in new["id_to_obj"][key] and new["id_to_obj"][key]["x_mitre_deprecated"]:
-                        if not "x_mitre_deprecated" in old["id_to_obj"][key]:   # if previously deprecated, not a change
-                            deprecations.add(key)
-                    else: # not revoked or deprecated
-                        # try getting version numbers; should only lack version numbers if something has gone
-                        # horribly wrong or a revoked object has slipped through
-                        try:
-                            old_version = float(old["id_to_obj"][key]["x_mitre_version"])
-                        except: 
-                            print("ERROR: cannot get old version for object: " + key)
-                        try:
-                            new_version = float(new["id_to_obj"][key]["x_mitre_version"])
-                        except: 
-                            print("ERROR: cannot get new version for object: " + key)
-
-                        # check for changes
-                        if new_version > old_version:
-                            # an update has occurred to this object
-                            changes.add(key)
-                        else:
-                            # check for minor change; modification date increased but not version
-                            old_date = dateparser.parse(old["id_to_obj"][key]["modified"])
-                            new_date = dateparser.parse(new["id_to_obj"][key]["modified"])
-                            if new_date > old_date:
-                                minor_changes.add(key)
-                            else :
-                                unchanged.add(key)
-                
-                # set data
-                if obj_type not in self.data: self.data[obj_type] = {}
-                self.data[obj_type][domain] = {
-                    "additions":     [new["id_to_obj"][key] for key in additions],
-                    "changes":       [new["id_to_obj"][key] for key in changes]
-                }
-                # only create minor_changes data if we want to display it later
-                if self.minor_changes:
-                    self.data[obj_type][domain]["minor_changes"] = [new["id_to_obj"][key] for key in minor_changes]
-                
-                # ditto for unchanged
-                if self.unchanged:
-                    self.data[obj_type][domain]["unchanged"] = [new["id_to_obj"][key] for key in unchanged]
-
-                self.data[obj_type][domain]["revocations"] = [new["id_to_obj"][key] for key in revocations]
-                self.data[obj_type][domain]["deprecations"] = [new["id_to_obj"][key] for key in deprecations]
-                # only show deletions if objects were deleted
-                if len(deletions) > 0:
-                    self.data[obj_type][domain]["deletions"] = [old["id_to_obj"][key] for key in deletions]
+                        self.diff_type(obj_type, domain, old, new)
                 if self.verbose:
                     pbar.update(1)
         if self.verbose:
             pbar.close()
 
 
+    def stream_side(self, datafile, tmpdir):
+        """
+        Stream a bundle file and return the summaries of its objects sorted by stixID, for load_data_streaming.
+
+        Returns a dict with:
+            records: iterator over [stixID, start, end, summary] for each object of self.types, sorted by stixID
+            revoked_by: revoked stixID => revoking stixID, from the revoked-by relationships
+            techniques: the stixID, name and ATT&CK ID of every technique in the bundle
+            subtechnique_of_rels: the summary of every subtechnique-of relationship in the bundle
+            relationship_count: a list with the number of relationships in the bundle
+            bundle_path: the bundle file, which start and end are byte offsets in
+        """
+        stix_types = set(stix_type for obj_type in self.types for stix_type in attackTypeToStixTypes[obj_type])
+        revoked_by = {}
+        techniques = []
+        subtechnique_of_rels = []
+        relationship_count = [0] # in a list so records can update it
+
+        def records():
+            for obj, start, end in stream_bundle(datafile):
+                if obj["type"] == "relationship":
+                    relationship_count[0] += 1
+                    if obj["relationship_type"] == "revoked-by":
+                        revoked_by.setdefault(obj["source_ref"], obj["target_ref"])
+                    elif obj["relationship_type"] == "subtechnique-of":
+                        subtechnique_of_rels.append(summarize_stix(obj))
+                elif obj["type"] == "attack-pattern":
+                    technique = {"id": obj["id"], "name": obj["name"]}
+                    if attack_id(obj):
+                        technique["external_references"] = [{"external_id": attack_id(obj)}]
+                    techniques.append(technique)
+                if obj["type"] in stix_types:
+                    yield obj["id"], start, end, summarize_stix(obj, with_content_hash=self.field_changes)
+
+        return {
+            # sorting reads the whole bundle, so the other indexes are complete once it returns
+            "records": sort_records(records(), tmpdir, self.run_size),
+            "revoked_by": revoked_by,
+            "techniques": techniques,
+            "subtechnique_of_rels": subtechnique_of_rels,
+            "relationship_count": relationship_count,
+            "bundle_path": datafile
+        }
+
+
+    def load_data_streaming(self):
+        """
+        Load data from the old and new directories into data dict without holding either bundle in memory.
+
+        Each bundle is streamed and the summaries of its objects are sorted by stixID in on-disk runs of self.run_size.
+        The sorted old and new summaries are merge-joined and each object is classified as it is read. Only the summaries
+        and byte offsets of the objects in the output are kept, and the full objects are read from the bundle files by
+        store_diff, so the result is the same as load_data.
+        """
+        if self.use_taxii:
+            raise ValueError("low_memory does not support use_taxii")
+        if "relationship" in self.types:
+            raise ValueError("low_memory does not support the relationship type")
+        stix_type_to_type = {stix_type: obj_type for obj_type in self.types for stix_type in attackTypeToStixTypes[obj_type]}
+
+        if self.verbose:
+            pbar = tqdm(total=len(self.types) * len(self.domains), desc="loading data", bar_format="{l_bar}{bar}| [{elapsed}<{remaining}, {rate_fmt}{postfix}]")
+        for domain in self.domains:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with self.timed("parse"):
+                    old = self.stream_side(os.path.join(self.old, domain + ".json"), tmpdir)
+                    new = self.stream_side(os.path.join(self.new, domain + ".json"), tmpdir)
+                for side, streamed in [("old", old), ("new", new)]:
+                    for obj_type in self.types:
+                        self.counts.setdefault(obj_type, {}).setdefault(domain, {})[side] = 0
+                    self.counts.setdefault("relationship", {}).setdefault(domain, {})[side] = streamed["relationship_count"][0]
+                self.parse_subtechniques(old, False)
+                self.parse_subtechniques(new, True)
+
+                # loaded views like those of load_cached_bundle, holding only the objects store_diff needs
+                old_view = {"id_to_obj": {obj_type: {} for obj_type in self.types}, "offsets": {}, "bundle_path": old["bundle_path"], "materialized": {}}
+                new_view = {"id_to_obj": {obj_type: {} for obj_type in self.types}, "offsets": {}, "bundle_path": new["bundle_path"], "materialized": {}, "revoked_by": new["revoked_by"]}
+                def keep(view, record):
+                    key, start, end, summary = record
+                    view["id_to_obj"][stix_type_to_type[summary["type"]]][key] = summary
+                    view["offsets"][key] = (start, end)
+
+                sections = {obj_type: {section: set() for section in sectionNameToSectionHeaders} for obj_type in self.types}
+                revokers = set(new["revoked_by"].values())
+                with self.timed("set_diff"):
+                    for old_record, new_record in merge_join(old["records"], new["records"]):
+                        for side, side_record in [("old", old_record), ("new", new_record)]:
+                            if side_record is not None:
+                                self.counts[stix_type_to_type[side_record[3]["type"]]][domain][side] += 1
+                        if new_record is None:
+                            section = "deletions"
+                        elif old_record is None:
+                            section = "additions"
+                        else:
+                            section = self.classify(new_record[0], old_record[3], new_record[3], new["revoked_by"])
+                        if new_record is not None and new_record[0] in revokers:
+                            keep(new_view, new_record)
+                        if section is None: continue
+                        if section == "minor_changes" and not self.minor_changes: continue
+                        if section == "unchanged" and not self.unchanged: continue
+
+                        record = new_record or old_record
+                        sections[stix_type_to_type[record[3]["type"]]][section].add(record[0])
+                        if section != "additions":
+                            keep(old_view, old_record)
+                        if section != "deletions":
+                            keep(new_view, new_record)
+
+                    for obj_type in self.types:
+                        self.store_diff(obj_type, domain, sections[obj_type], old_view, new_view)
+                        if self.verbose:
+                            pbar.update(1)
+        if self.verbose:
+            pbar.close()
+
+
+    def diff_type(self, obj_type, domain, old, new):
+        """
+        Classify the objects of one type in one domain and store the result in the data dict.
+
+        old and new are the loaded views returned by load_objects. Objects are classified from the fields in
+        summaryFields, and only the objects which end up in the data dict are materialized.
+        """
+        old_id_to_obj = old["id_to_obj"][obj_type]
+        new_id_to_obj = new["id_to_obj"][obj_type]
+        old_keys = set(old_id_to_obj.keys())
+        new_keys = set(new_id_to_obj.keys())
+
+        # sets to store the ids of objects for each section
+        sections = {section: set() for section in sectionNameToSectionHeaders}
+        sections["additions"] = new_keys - old_keys
+        sections["deletions"] = old_keys - new_keys
+
+        # find changes, revocations and deprecations
+        for key in old_keys & new_keys:
+            section = self.classify(key, old_id_to_obj[key], new_id_to_obj[key], new["revoked_by"])
+            if section is not None:
+                sections[section].add(key)
+
+        self.store_diff(obj_type, domain, sections, old, new)
+
+
+    def classify(self, key, old_obj, new_obj, revoked_by):
+        """
+        Return the section of an object present in both the old and new data, or None if it isn't reported.
+
+        old_obj and new_obj can be summaries; only the fields in summaryFields are used. revoked_by maps revoked stixIDs
+        of the new data to their revoking stixIDs.
+        """
+        if "revoked" in new_obj and new_obj["revoked"]:
+            if not "revoked" in old_obj or not old_obj["revoked"]: # if it was previously revoked, it's not a change
+                if key not in revoked_by:
+                    print("WARNING: revoked object", key, "has no revoked-by relationship")
+                    return None
+                return "revocations"
+            # else it was already revoked, and not a change; do nothing with it
+            return None
+        elif "x_mitre_deprecated" in new_obj and new_obj["x_mitre_deprecated"]:
+            if not "x_mitre_deprecated" in old_obj:   # if previously deprecated, not a change
+                return "deprecations"
+            return None
+        # not revoked or deprecated
+        # try getting version numbers; should only lack version numbers if something has gone
+        # horribly wrong or a revoked object has slipped through
+        try:
+            old_version = float(old_obj["x_mitre_version"])
+        except: 
+            print("ERROR: cannot get old version for object: " + key)
+        try:
+            new_version = float(new_obj["x_mitre_version"])
+        except: 
+            print("ERROR: cannot get new version for object: " + key)
+
+        # check for changes
+        if new_version > old_version:
+            # an update has occurred to this object
+            return "changes"
+        # check for minor change; modification date increased but not version
+        old_modified = old_obj["modified"]
+        new_modified = new_obj["modified"]
+        # identical timestamps can't be a minor change, so skip parsing them
+        if new_modified != old_modified and parse_timestamp(new_modified) > parse_timestamp(old_modified):
+            return "minor_changes"
+        return "unchanged"
+
+
+    def store_diff(self, obj_type, domain, sections, old, new):
+        """
+        Store the classified objects of one type in one domain in the data dict.
+
+        sections maps each section name to the set of stixIDs in it. old and new are loaded views, which only need to
+        contain the objects of the sections which are reported, and the revoking objects.
+        """
+        old_id_to_obj = old["id_to_obj"][obj_type]
+        new_id_to_obj = new["id_to_obj"][obj_type]
+        old_obj = lambda key: self.materialize(old, old_id_to_obj[key])
+        new_obj = lambda key: self.materialize(new, new_id_to_obj[key])
+
+        # objects are annotated on a copy, since loaded bundles can be shared with other diffs
+        annotated = {} # stixID => copy of the new object with its revoking object or changed fields
+
+        # store the revoking objects
+        with self.timed("revocations"):
+            for key in sections["revocations"]:
+                annotated[key] = dict(new_obj(key), revoked_by=new_obj(new["revoked_by"][key]))
+
+        # find which fields changed by comparing per-field hashes
+        if self.field_changes:
+            with self.timed("field_changes"):
+                for key in sections["changes"] | sections["minor_changes"]:
+                    if "content_hash" in old_id_to_obj[key] and old_id_to_obj[key]["content_hash"] == new_id_to_obj[key].get("content_hash"):
+                        changed_fields = [] # summaries from the bundle cache show the content is the same
+                    else:
+                        old_hashes = hash_fields(old_obj(key))
+                        new_hashes = hash_fields(new_obj(key))
+                        changed_fields = sorted(
+                            field for field in old_hashes.keys() | new_hashes.keys() if old_hashes.get(field) != new_hashes.get(field)
+                        )
+                    annotated[key] = dict(new_obj(key), changed_fields=changed_fields)
+
+        for section in ["changes", "minor_changes", "unchanged", "revocations", "deprecations"]:
+            if section in ["minor_changes", "unchanged"] and not getattr(self, section): continue
+            for key in sections[section]:
+                self.old_versions[(domain, key)] = old_id_to_obj[key].get("x_mitre_version")
+
+        # set data
+        if obj_type not in self.data: self.data[obj_type] = {}
+        self.data[obj_type][domain] = {
+            "additions":     [new_obj(key) for key in sections["additions"]],
+            "changes":       [annotated.get(key) or new_obj(key) for key in sections["changes"]]
+        }
+        # only create minor_changes data if we want to display it later
+        if self.minor_changes:
+            self.data[obj_type][domain]["minor_changes"] = [annotated.get(key) or new_obj(key) for key in sections["minor_changes"]]
+        
+        # ditto for unchanged
+        if self.unchanged:
+            self.data[obj_type][domain]["unchanged"] = [new_obj(key) for key in sections["unchanged"]]
+
+        self.data[obj_type][domain]["revocations"] = [annotated[key] for key in sections["revocations"]]
+        self.data[obj_type][domain]["deprecations"] = [new_obj(key) for key in sections["deprecations"]]
+        # only show deletions if objects were deleted
+        if len(sections["deletions"]) > 0:
+            self.data[obj_type][domain]["deletions"] = [old_obj(key) for key in sections["deletions"]]
+
+
+    def diff_relationships(self, domain, old, new):
+        """
+        Find the relationships added, removed and re-described in one domain and store them in the data dict.
+
+        Relationships are hash joined on (source_ref, relationship_type, target_ref). revoked-by relationships, and
+        relationships which are revoked or deprecated, are left out since they are covered by the other types.
+        """
+        def edges(loaded):
+            # (source_ref, relationship_type, target_ref) => relationship
+            edge_to_rel = {}
+            for relationship in loaded["id_to_obj"]["relationship"].values():
+                if relationship["relationship_type"] == "revoked-by": continue
+                if relationship.get("revoked", False) or relationship.get("x_mitre_deprecated", False): continue
+                edge_to_rel[(relationship["source_ref"], relationship["relationship_type"], relationship["target_ref"])] = relationship
+            return edge_to_rel
+
+        def label(loaded, ref):
+            # the name of a relationship's endpoint, with its ATT&CK ID if it has one
+            named = loaded["id_to_named"].get(ref)
+            if named is None:
+                return ref
+            if "external_references" in named and "external_id" in named["external_references"][0]:
+                return f"{named['name']} ({named['external_references'][0]['external_id']})"
+            return named["name"]
+
+        def labelled(loaded, relationship):
+            # a copy of the full relationship labelled with the names of its endpoints, since loaded bundles can be
+            # shared with other diffs
+            relationship = self.materialize(loaded, relationship)
+            return dict(
+                relationship,
+                source_name=label(loaded, relationship["source_ref"]),
+                target_name=label(loaded, relationship["target_ref"])
+            )
+
+        old_edges = edges(old)
+        new_edges = edges(new)
+        old_keys = old_edges.keys()
+        new_keys = new_edges.keys()
+
+        redescribed = [
+            labelled(new, new_edges[key]) for key in new_keys & old_keys
+            if description_hash(new_edges[key]) != description_hash(old_edges[key])
+        ]
+
+        if "relationship" not in self.data: self.data["relationship"] = {}
+        self.data["relationship"][domain] = {
+            "additions": [labelled(new, new_edges[key]) for key in new_keys - old_keys],
+            "changes":   redescribed
+        }
+        removed = [labelled(old, old_edges[key]) for key in old_keys - new_keys]
+        # only show deletions if relationships were removed
+        if len(removed) > 0:
+            self.data["relationship"][domain]["deletions"] = removed
+
+
     def get_md_key(self):
         """
         Create string describing each type of difference (change, addition, etc). Used in get_markdown_string.
@@ -350,17 +1254,36 @@ class DiffStix(object):
 
     def has_subtechniques(self, sdo, new=False):
         """return true or false depending on whether the SDO has sub-techniques. new determines whether to parse from the new or old data"""
-        if new: return len(list(filter(lambda rel: rel["target_ref"] == sdo["id"], self.new_subtechnique_of_rels))) > 0
-        else:   return len(list(filter(lambda rel: rel["target_ref"] == sdo["id"], self.old_subtechnique_of_rels))) > 0
+        if new: return sdo["id"] in self.new_parent_to_children
+        else:   return sdo["id"] in self.old_parent_to_children
 
     def get_markdown_string(self):
         """
         Return a markdown string summarizing detected differences.
         """
+        content = io.StringIO()
+        self.write_markdown(content)
+        return content.getvalue()
+
+
+    @timed_phase("markdown")
+    def write_markdown(self, fp):
+        """
+        Write markdown summarizing detected differences to the file-like object fp.
+
+        Each section is written as it is generated, so the whole report is never held in memory.
+        """
+
+        def getRelationshipList(items):
+            """
+            yield a line for each relationship in a section
+            """
+            for relationship in sorted(items, key=lambda rel: (rel["source_name"], rel["relationship_type"], rel["target_name"])):
+                yield f"* {relationship['source_name']} {relationship['relationship_type']} {relationship['target_name']}\n"
         
         def getSectionList(items, obj_type, section):
             """
-            parse a list of items in a section and return a string for the items
+            parse a list of items in a section and yield a line for each item
             """
             
             # get parents which have children
@@ -368,19 +1291,14 @@ class DiffStix(object):
             parents = list(filter(lambda item: self.has_subtechniques(item, True) and not ("x_mitre_is_subtechnique" in item and item["x_mitre_is_subtechnique"]), items))
             children = { item["id"]: item for item in filter(lambda item: "x_mitre_is_subtechnique" in item and item["x_mitre_is_subtechnique"], items) }
 
-            subtechnique_of_rels = self.new_subtechnique_of_rels if section != "deletions" else self.old_subtechnique_of_rels
+            child_to_parent = self.new_child_to_parent if section != "deletions" else self.old_child_to_parent
             id_to_technique = self.new_id_to_technique if section != "deletions" else self.old_id_to_technique
 
+            # select the parents of the children in this section from the child => parent index
             parentToChildren = {} # stixID => [ children ]
-            for relationship in subtechnique_of_rels:
-                if relationship["target_ref"] in parentToChildren:
-                    if relationship["source_ref"] in children:
-                        parentToChildren[relationship["target_ref"]].append(children[relationship["source_ref"]])
-                else:
-                    if relationship["source_ref"] in children:
-                        parentToChildren[relationship["target_ref"]] = children[relationship["source_ref"]]
-                        parentToChildren[relationship["target_ref"]] = [ children[relationship["source_ref"]] ]
-
+            for childID, child in children.items():
+                if childID in child_to_parent:
+                    parentToChildren.setdefault(child_to_parent[childID], []).append(child)
 
             # now group parents and children
             groupings = []
@@ -408,7 +1326,7 @@ class DiffStix(object):
                     revoker = item['revoked_by']
                     if "x_mitre_is_subtechnique" in revoker and revoker["x_mitre_is_subtechnique"]:
                         # get revoking technique's parent for display
-                        parentID = list(filter(lambda rel: rel["source_ref"] == revoker["id"], subtechnique_of_rels))[0]["target_ref"]
+                        parentID = child_to_parent[revoker["id"]]
                         parentName = id_to_technique[parentID]["name"] if parentID in id_to_technique else "ERROR NO PARENT"
                         return f"{item['name']} (revoked by { parentName}: [{revoker['name']}]({self.site_prefix}/{self.getUrlFromStix(revoker, True)}))"
                     else:
@@ -417,56 +1335,183 @@ class DiffStix(object):
                     return f"{item['name']}"
                 else:
                     is_subtechnique = item["type"] == "attack-pattern" and "x_mitre_is_subtechnique" in item and item["x_mitre_is_subtechnique"]
-                    return f"[{item['name']}]({self.site_prefix}/{self.getUrlFromStix(item, is_subtechnique)})"
+                    link = f"[{item['name']}]({self.site_prefix}/{self.getUrlFromStix(item, is_subtechnique)})"
+                    if "changed_fields" in item and item["changed_fields"]:
+                        return f"{link} (changed fields: {', '.join(item['changed_fields'])})"
+                    return link
 
 
-            # build sectionList string
-            sectionString = ""
+            # yield sectionList lines
             for grouping in groupings:
                 if grouping["parentInSection"]:
-                    sectionString += f"* { placard(grouping['parent']) }\n"
+                    yield f"* { placard(grouping['parent']) }\n"
                 # else:
-                #     sectionString += f"* _{grouping['parent']['name']}_\n"
+                #     yield f"* _{grouping['parent']['name']}_\n"
                 for child in sorted(grouping["children"], key=lambda child: child["name"]):
                     if grouping["parentInSection"]:
-                        sectionString += f"\t* {placard(child) }\n"
+                        yield f"\t* {placard(child) }\n"
                     else:
-                        sectionString += f"* { grouping['parent']['name'] }: { placard(child) }\n"
+                        yield f"* { grouping['parent']['name'] }: { placard(child) }\n"
 
-            return sectionString
+        self.verboseprint("writing markdown... ", end="", flush="true")
 
-        self.verboseprint("generating markdown string... ", end="", flush="true")
+        if self.show_key:
+            fp.write(f"{self.get_md_key()}\n\n")
 
-        content = ""
         for obj_type in self.data.keys():
-            domains = ""
+            fp.write(f"### {attackTypeToPlural[obj_type].capitalize()}\n\n") # e.g "techniques"
             for domain in self.data[obj_type]:
-                domain_sections = ""
+                fp.write(f"**{domainToDomainLabel[domain]}**\n\n") # e.g "enterprise"
                 for section in self.data[obj_type][domain]:
-                    if len(self.data[obj_type][domain][section]) > 0: # if there are items in the section
-                        section_items = getSectionList(self.data[obj_type][domain][section], obj_type, section)
-                    else: # no items in section
-                        section_items = "No changes"
                     header = sectionNameToSectionHeaders[section] + ":"
                     if "{obj_type}" in header:
                         if section == "additions":
                             header = header.replace("{obj_type}", attackTypeToPlural[obj_type].capitalize())
                         else: header = header.replace("{obj_type}", obj_type.capitalize())
-                    if section_items == "No changes":
-                        domain_sections += f"{header}\n{section_items}\n\n" # e.g "added techniques:"
-                    else: domain_sections += f"{header}\n\n{section_items}\n\n" # add empty line between header and section list
-                domains += f"**{domainToDomainLabel[domain]}**\n\n{domain_sections}" # e.g "enterprise"
-            content += f"### {attackTypeToPlural[obj_type].capitalize()}\n\n{domains}" # e.g "techniques"
+                    if len(self.data[obj_type][domain][section]) > 0: # if there are items in the section
+                        fp.write(f"{header}\n\n") # add empty line between header and section list
+                        if obj_type == "relationship":
+                            fp.writelines(getRelationshipList(self.data[obj_type][domain][section]))
+                        else:
+                            fp.writelines(getSectionList(self.data[obj_type][domain][section], obj_type, section))
+                        fp.write("\n\n")
+                    else: # no items in section
+                        fp.write(f"{header}\nNo changes\n\n") # e.g "added techniques:"
 
-        if self.show_key:
-            key_content = self.get_md_key()
-            content = f"{key_content}\n\n{content}"
+        self.verboseprint("done")
+
+
+    def get_ndjson_records(self):
+        """
+        Yield a dict for each object in the detected differences, for write_ndjson.
+
+        Records are generated from self.data, so they are only yielded once the whole diff has been loaded and stored,
+        and the full result is held in memory while they are. Objects are yielded by type, domain and section, sorted by
+        name within each section. Each record has the domain,
+        type, section, stix_id, attack_id, name, old_version and new_version of the object, along with revoked_by and
+        parent, which are dicts with the stix_id, attack_id and name of the revoking object and of a sub-technique's parent,
+        or None. Changed objects also have changed_fields when field changes are detected. Relationship records instead
+        have the relationship_type and the ref and name of its source and target.
+        """
+        def reference(obj):
+            if obj is None: return None
+            return {"stix_id": obj["id"], "attack_id": attack_id(obj), "name": obj["name"]}
+
+        for obj_type in self.data:
+            for domain in self.data[obj_type]:
+                for section in self.data[obj_type][domain]:
+                    items = self.data[obj_type][domain][section]
+                    if obj_type == "relationship":
+                        for relationship in sorted(items, key=lambda rel: (rel["source_name"], rel["relationship_type"], rel["target_name"])):
+                            yield {
+                                "domain": domain,
+                                "type": obj_type,
+                                "section": section,
+                                "stix_id": relationship["id"],
+                                "relationship_type": relationship["relationship_type"],
+                                "source_ref": relationship["source_ref"],
+                                "source_name": relationship["source_name"],
+                                "target_ref": relationship["target_ref"],
+                                "target_name": relationship["target_name"]
+                            }
+                        continue
+
+                    child_to_parent = self.new_child_to_parent if section != "deletions" else self.old_child_to_parent
+                    id_to_technique = self.new_id_to_technique if section != "deletions" else self.old_id_to_technique
+                    for item in sorted(items, key=lambda item: item["name"]):
+                        parent = None
+                        if item.get("x_mitre_is_subtechnique") and item["id"] in child_to_parent:
+                            parent = id_to_technique.get(child_to_parent[item["id"]])
+                        version = item.get("x_mitre_version")
+                        record = {
+                            "domain": domain,
+                            "type": obj_type,
+                            "section": section,
+                            "stix_id": item["id"],
+                            "attack_id": attack_id(item),
+                            "name": item["name"],
+                            "old_version": version if section == "deletions" else self.old_versions.get((domain, item["id"])),
+                            "new_version": None if section == "deletions" else version,
+                            "revoked_by": reference(item.get("revoked_by")),
+                            "parent": reference(parent)
+                        }
+                        if "changed_fields" in item:
+                            record["changed_fields"] = item["changed_fields"]
+                        yield record
+
+
+    @timed_phase("ndjson")
+    def write_ndjson(self, fp):
+        """
+        Write the detected differences as newline-delimited JSON to the file-like object fp, one line per object.
 
+        Lines are written as they are generated rather than built up as one string, but only after the whole diff has been
+        loaded, see get_ndjson_records for the format.
+        """
+        self.verboseprint("writing ndjson... ", end="", flush="true")
+        for record in self.get_ndjson_records():
+            fp.write(json.dumps(record) + "\n")
         self.verboseprint("done")
 
-        return content
+
+    def get_field_changes_dict(self):
+        """
+        Return the fields which changed for each changed object, in dict format. Requires the field_changes argument.
+
+        Returns a dict mapping type to domain to a list of changed objects sorted by name.
+        """
+        field_changes = {}
+        for obj_type in self.data:
+            if obj_type == "relationship": continue # relationship changes are always description changes
+            field_changes[obj_type] = {}
+            for domain in self.data[obj_type]:
+                changed = []
+                for section in ["changes", "minor_changes"]:
+                    for item in self.data[obj_type][domain].get(section, []):
+                        changed.append({
+                            "id": item["id"],
+                            "name": item["name"],
+                            "section": section,
+                            "changed_fields": item.get("changed_fields", [])
+                        })
+                field_changes[obj_type][domain] = sorted(changed, key=lambda change: change["name"])
+        return field_changes
+
+
+    def get_metrics_dict(self):
+        """
+        Return the timings, object counts and peak memory of the diff so far, in dict format.
+
+        Returns a dict with:
+            seconds: wall time spent in each phase. The phases are parse (reading bundles, or waiting for them to be read
+                with jobs), deep_copy, set_diff, revocations (resolving revoking objects), field_changes, markdown, ndjson
+                and layers. Phases which haven't run are left out
+            counts: type => domain => the number of objects in the old and new data and in each reported section. The
+                relationship type counts every relationship, even if relationships aren't reported on
+            peak_memory: peak traced memory in bytes, or None unless the metrics argument was given. Memory used by other
+                processes with jobs isn't traced. The first call stops the tracing started for the metrics argument, so
+                later calls report the same peak
+        """
+        counts = {obj_type: {domain: dict(domain_counts) for domain, domain_counts in type_counts.items()} for obj_type, type_counts in self.counts.items()}
+        for obj_type in self.data:
+            for domain in self.data[obj_type]:
+                for section, items in self.data[obj_type][domain].items():
+                    counts[obj_type][domain][section] = len(items)
+        if self.tracing:
+            # stop the tracing this object started, so it doesn't slow down the rest of the process
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.tracing = False
+        elif self.metrics and tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+        return {
+            "seconds": dict(self.phase_seconds),
+            "counts": counts,
+            "peak_memory": self.peak_memory
+        }
 
 
+    @timed_phase("layers")
     def get_layers_dict(self):
         """
         Return ATT&CK Navigator layers in dict format summarizing detected differences. Returns a dict mapping domain to its layer dict.
@@ -522,18 +1567,41 @@ class DiffStix(object):
         return layers
 
 
-def markdown_string_to_file(outfile, content):
-    """
-    Print the string passed in to the indicated output file.
+def diff_releases(releases, summary=False, **kwargs):
     """
+    Diff every consecutive pair of an ordered list of release directories, parsing each release's bundles only once.
 
-    verboseprint("writing markdown string to file... ", end="", flush="true")
+    params:
+        releases: list of release directories, oldest first
+        summary: if true, also diff the first release against the last
+        kwargs: passed on to each DiffStix, e.g. domains, types, minor_changes
 
-    outfile = open(outfile, "w")
-    outfile.write(content)
-    outfile.close()
+    returns a list of (old directory, new directory, DiffStix) for each diff
+    """
+    loaded_bundles = {}
+    pairs = list(zip(releases, releases[1:]))
+    if summary and len(releases) > 2:
+        pairs.append((releases[0], releases[-1]))
+
+    diffs = []
+    for old, new in pairs:
+        diffs.append((old, new, DiffStix(old=old, new=new, loaded_bundles=loaded_bundles, **kwargs)))
+        # forget releases no later diff needs
+        if not (summary and old == releases[0]):
+            for key in [key for key in loaded_bundles if key[0] == old]:
+                del loaded_bundles[key]
+    return diffs
+
+
+def diffs_to_markdown_file(outfile, diffs):
+    """
+    Print the markdown for each diff returned by diff_releases to the indicated output file, under a heading per diff.
+    """
 
-    verboseprint("done")
+    with open(outfile, "w") as f:
+        for old, new, diffStix in diffs:
+            f.write(f"## {old} to {new}\n\n")
+            diffStix.write_markdown(f)
 
 
 def layers_dict_to_files(outfiles, layers):
@@ -550,6 +1618,32 @@ def layers_dict_to_files(outfiles, layers):
     verboseprint("done")
 
 
+def metrics_dict_to_file(outfile, metrics):
+    """
+    Print the metrics dict passed in to a JSON file.
+    """
+
+    verboseprint("writing metrics to file... ", end="", flush="true")
+
+    with open(outfile, "w") as f:
+        json.dump(metrics, f, indent=4)
+
+    verboseprint("done")
+
+
+def field_changes_dict_to_file(outfile, field_changes):
+    """
+    Print the field changes dict passed in to a JSON file.
+    """
+
+    verboseprint("writing field changes to file... ", end="", flush="true")
+
+    with open(outfile, "w") as f:
+        json.dump(field_changes, f, indent=4)
+
+    verboseprint("done")
+
+
 if __name__ == '__main__':
     old_dir_default = "old"
     date = datetime.datetime.today()
@@ -577,17 +1671,29 @@ if __name__ == '__main__':
         help="the directory of the new content. Default is '%(default)s'"
     )
 
+    parser.add_argument("-releases",
+        type=str,
+        nargs="+",
+        metavar="RELEASE_DIR",
+        help="diff each consecutive pair of an ordered list of release directories, oldest first, parsing each release only once. Cannot be used with -old, -new or --use-taxii, and only -markdown output is supported"
+    )
+
+    parser.add_argument("--summary",
+        action="store_true",
+        help="with -releases, also diff the first release against the last"
+    )
+
     parser.add_argument("-types",
         type=str,
         nargs="+",
         metavar=("OBJ_TYPE", "OBJ_TYPE"),
         choices=[
-            "technique", "software", "group", "mitigation"
+            "technique", "software", "group", "mitigation", "relationship"
         ],
         default=[
             "technique", "software", "group", "mitigation"
         ],
-        help="which types of objects to report on. Choices (and defaults) are %(choices)s"
+        help="which types of objects to report on. Choices are %(choices)s. Defaults are %(default)s"
     )
 
     parser.add_argument("-domains",
@@ -621,6 +1727,12 @@ if __name__ == '__main__':
              '''
     )
 
+    parser.add_argument("-ndjson",
+        type=str,
+        metavar="OUTFILE",
+        help="write one JSON record per reported object to a newline-delimited JSON file, once the diff is complete"
+    )
+
     parser.add_argument("-site_prefix",
         type=str,
         default="",
@@ -644,7 +1756,58 @@ if __name__ == '__main__':
 
     parser.add_argument("--use-taxii",
         action="store_true",
-        help="Use content from the ATT&CK TAXII server for the -old data"
+        help="Use content from the ATT&CK TAXII server for the -old data. With -cache_dir, the content is only fetched the first time unless --refresh-taxii is used"
+    )
+
+    parser.add_argument("--refresh-taxii",
+        action="store_true",
+        help="with --use-taxii and -cache_dir, fetch the TAXII content again instead of using the cached content"
+    )
+
+    parser.add_argument("-taxii_added_after",
+        type=str,
+        metavar="TIMESTAMP",
+        help="with --use-taxii, only use the objects added to the TAXII server after this timestamp, e.g. 2020-07-01T00:00:00Z"
+    )
+
+    parser.add_argument("--strict",
+        action="store_true",
+        help="validate the content of the -old and -new directories by parsing it with the stix2 library. Slower and uses more memory"
+    )
+
+    parser.add_argument("--jobs",
+        type=int,
+        metavar="N",
+        default=1,
+        help="load the old and new bundles of each domain concurrently in N processes. Default is %(default)s"
+    )
+
+    parser.add_argument("--field-changes",
+        action="store_true",
+        help="list which fields changed for each changed object in the markdown output"
+    )
+
+    parser.add_argument("-field_changes_json",
+        type=str,
+        metavar="OUTFILE",
+        help="write the fields which changed for each changed object to a JSON file. Implies --field-changes"
+    )
+
+    parser.add_argument("-cache_dir",
+        type=str,
+        metavar="CACHE_DIR",
+        help="cache a compact index of each bundle in this directory. Bundles which haven't changed since they were cached are diffed from the index, and only the objects in the output are parsed. Cannot be used with --strict"
+    )
+
+    parser.add_argument("--low-memory",
+        action="store_true",
+        help="stream the -old and -new bundles and diff them with an on-disk sort-merge join, so memory use doesn't grow with the size of the bundles. Cannot be used with --use-taxii, -releases, --strict, --jobs, -cache_dir or the relationship type"
+    )
+
+    parser.add_argument("--metrics",
+        type=str,
+        metavar="OUTFILE",
+        help="write the time spent in each phase of the diff, the number of objects of each type in each domain and the peak memory to a JSON file"
     )
 
     parser.add_argument("--show-key",
@@ -656,14 +1819,63 @@ if __name__ == '__main__':
 
     if args.use_taxii and args.old is not None:
         parser.error('--use-taxii and -old cannot be used together')
+
+    if args.releases is not None:
+        if args.old is not None or args.new != "new" or args.use_taxii:
+            parser.error('-releases cannot be used with -old, -new or --use-taxii')
+        if len(args.releases) < 2:
+            parser.error('-releases requires at least two release directories')
+        if args.layers is not None or args.field_changes_json or args.ndjson or args.metrics:
+            parser.error('-releases only supports -markdown output')
         
-    if (not args.markdown and args.layers is None):
-        print("Script doesn't output anything unless -markdown and/or -layers are specified. Run 'python3 diff_stix.py -h' for usage instructions")
+    if args.refresh_taxii and not (args.use_taxii and args.cache_dir):
+        parser.error('--refresh-taxii can only be used with --use-taxii and -cache_dir')
+
+    if args.cache_dir and args.strict:
+        parser.error('-cache_dir and --strict cannot be used together')
+
+    if args.low_memory:
+        if args.use_taxii or args.releases is not None or args.strict or args.jobs > 1 or args.cache_dir:
+            parser.error('--low-memory cannot be used with --use-taxii, -releases, --strict, --jobs or -cache_dir')
+        if "relationship" in args.types:
+            parser.error('--low-memory does not support the relationship type')
+
+    if args.field_changes_json:
+        args.field_changes = True
+
+    if (not args.markdown and args.layers is None and not args.field_changes_json and not args.ndjson):
+        print("Script doesn't output anything unless -markdown, -layers, -ndjson and/or -field_changes_json are specified. Run 'python3 diff_stix.py -h' for usage instructions")
         exit()
 
     if args.old is None:
         args.old = old_dir_default
 
+    if args.verbose:
+        def verboseprint(*args, **kwargs):
+                print(*args, **kwargs)
+    else:
+        verboseprint = lambda *a, **k: None    
+
+    if args.releases is not None:
+        diffs = diff_releases(
+            args.releases,
+            summary=args.summary,
+            domains=args.domains,
+            markdown=args.markdown,
+            minor_changes=args.minor_changes,
+            unchanged=args.unchanged,
+            show_key=args.show_key,
+            site_prefix=args.site_prefix,
+            types=args.types,
+            strict=args.strict,
+            jobs=args.jobs,
+            field_changes=args.field_changes,
+            cache_dir=args.cache_dir,
+            verbose=args.verbose
+        )
+        diffs_to_markdown_file(args.markdown, diffs)
+        exit()
+
     diffStix = DiffStix(
         domains=args.domains,
         layers=args.layers,
@@ -676,20 +1888,24 @@ if __name__ == '__main__':
         site_prefix=args.site_prefix,
         types=args.types,
         use_taxii=args.use_taxii,
+        taxii_added_after=args.taxii_added_after,
+        refresh_taxii=args.refresh_taxii,
+        strict=args.strict,
+        jobs=args.jobs,
+        field_changes=args.field_changes,
+        cache_dir=args.cache_dir,
+        low_memory=args.low_memory,
+        metrics=args.metrics is not None,
         verbose=args.verbose
     )
 
-    if args.verbose:
-        def verboseprint(*args, **kwargs):
-                print(*args, **kwargs)
-    else:
-        verboseprint = lambda *a, **k: None    
-
-    
-
     if args.markdown:
-        md_string = diffStix.get_markdown_string()
-        markdown_string_to_file(args.markdown, md_string)
+        with open(args.markdown, "w") as outfile:
+            diffStix.write_markdown(outfile)
+
+    if args.ndjson:
+        with open(args.ndjson, "w") as outfile:
+            diffStix.write_ndjson(outfile)
 
     if args.layers is not None:
         if len(args.layers) == 0:
@@ -703,4 +1919,11 @@ if __name__ == '__main__':
             parser.error('-layers requires exactly three files to be specified or none at all')
 
         layers_dict = diffStix.get_layers_dict()
-        layers_dict_to_files(args.layers, layers_dict)
\ No newline at end of file
+        layers_dict_to_files(args.layers, layers_dict)
+
+    if args.field_changes_json:
+        field_changes_dict = diffStix.get_field_changes_dict()
+        field_changes_dict_to_file(args.field_changes_json, field_changes_dict)
+
+    if args.metrics:
+        metrics_dict_to_file(args.metrics, diffStix.get_metrics_dict())
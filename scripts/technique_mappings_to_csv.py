@@ -1,6 +1,9 @@
 import argparse
+import contextlib
 import csv
 import io
+import itertools
+import os
 
 from stix2 import TAXIICollectionSource, MemorySource, Filter
 from taxii2client.v20 import Collection
@@ -36,30 +39,25 @@ def get_all_techniques(src, source_name, tactic=None):
     return remove_deprecated(results)
 
 
-def filter_for_term_relationships(src, relationship_type, object_id, target=True):
-    """Filters data source by type, relationship_type and source or target"""
+def index_relationships_by_target(src, relationship_type):
+    """Indexes the relationships of a relationship_type by target_ref, in a single query of the data source"""
     filters = [
         Filter("type", "=", "relationship"),
         Filter("relationship_type", "=", relationship_type),
     ]
-    if target:
-        filters.append(Filter("target_ref", "=", object_id))
-    else:
-        filters.append(Filter("source_ref", "=", object_id))
-
-    results = src.query(filters)
-    return remove_deprecated(results)
+    relationships_by_target = {}
+    for relationship in remove_deprecated(src.query(filters)):
+        relationships_by_target.setdefault(relationship.target_ref, []).append(relationship)
+    return relationships_by_target
 
 
-def filter_by_type_and_id(src, object_type, object_id, source_name):
-    """Filters data source by id and type"""
+def index_objects_by_id(src, object_types, source_name):
+    """Indexes the objects of the given types by id, in a single query of the data source"""
     filters = [
-        Filter("type", "=", object_type),
-        Filter("id", "=", object_id),
+        Filter("type", "in", tuple(object_types)),
         Filter("external_references.source_name", "=", source_name),
     ]
-    results = src.query(filters)
-    return remove_deprecated(results)
+    return {stix_object.id: stix_object for stix_object in remove_deprecated(src.query(filters))}
 
 
 def grab_external_id(stix_object, source_name):
@@ -92,42 +90,189 @@ def arg_parse():
     """Function to handle script arguments."""
     parser = argparse.ArgumentParser(description="Fetches the current ATT&CK content expressed as STIX2 and creates spreadsheet mapping Techniques with Mitigations, Groups or Software.")
     parser.add_argument("-d", "--domain", type=str, required=True, choices=["enterprise_attack", "mobile_attack"], help="Which ATT&CK domain to use (Enterprise, Mobile).")
-    parser.add_argument("-m", "--mapping-type", type=str, required=True, choices=["groups", "mitigations", "software"], help="Which type of object to output mappings for using ATT&CK content.")
+    parser.add_argument("-m", "--mapping-type", type=str, required=False, choices=["groups", "mitigations", "software"], help="Which type of object to output mappings for using ATT&CK content. Required unless --batch is used.")
     parser.add_argument("-t", "--tactic",  type=str, required=False,  help=" Filter based on this tactic name (e.g. initial-access) " )
     parser.add_argument("-s", "--save", type=str, required=False, help="Save the CSV file with a different filename.")
+    parser.add_argument("-b", "--batch", action="store_true", help="Load the domain once and output the mappings of every mapping type, both for all techniques (e.g. groups.csv) and for each tactic (e.g. groups_initial-access.csv). Cannot be used with --mapping-type, --tactic or --save.")
+    parser.add_argument("--tactics", type=str, nargs="+", required=False, help="With --batch, only output these tactics instead of every tactic of the domain.")
+    parser.add_argument("--low-memory", action="store_true", help="Write the rows as they're joined, iterating the techniques in ATT&CK ID order, instead of collecting and sorting all of them first, so memory use doesn't grow with the size of the output. The output is the same.")
+    parser.add_argument("-o", "--output-dir", type=str, default=".", help="With --batch, the directory in which to save the CSV files.")
     return parser
 
 
-def do_mapping(ds, fieldnames, relationship_type, type_filter, source_name, sorting_keys, tactic=None):
-    """Main logic to map techniques to mitigations, groups or software"""
-    all_attack_patterns = get_all_techniques(ds, source_name, tactic)
-    writable_results = []
-
-    for attack_pattern in tqdm.tqdm(all_attack_patterns, desc="parsing data for techniques"):
+# The output of each mapping type. Software are defined in STIX as both malware and tool objects
+mapping_configs = {
+    "groups": {
+        "filename": "groups.csv",
+        "fieldnames": ("TID", "Technique Name", "GID", "Group Name", "Group Description", "Usage"),
+        "relationship_type": "uses",
+        "type_filter": ("intrusion-set",),
+        "sorting_keys": ("TID", "GID"),
+    },
+    "mitigations": {
+        "filename": "mitigations.csv",
+        "fieldnames": ("TID", "Technique Name", "MID", "Mitigation Name", "Mitigation Description", "Application"),
+        "relationship_type": "mitigates",
+        "type_filter": ("course-of-action",),
+        "sorting_keys": ("TID", "MID"),
+    },
+    "software": {
+        "filename": "software.csv",
+        "fieldnames": ("TID", "Technique Name", "SID", "Software Name", "Software Description", "Use"),
+        "relationship_type": "uses",
+        "type_filter": ("malware", "tool"),
+        "sorting_keys": ("TID", "SID"),
+    },
+}
+
+
+def join_mappings(attack_patterns, relationships_by_target, objects_by_id, source_name):
+    """Joins techniques to the mapped objects through the indexed relationships, yielding each technique with the row data of each of its mappings"""
+    for attack_pattern in attack_patterns:
         # Grabs relationships for identified techniques
-        relationships = filter_for_term_relationships(ds, relationship_type, attack_pattern.id)
+        relationships = relationships_by_target.get(attack_pattern.id, [])
 
         for relationship in relationships:
-            # Groups are defined in STIX as intrusion-set objects
-            # Mitigations are defined in STIX as course-of-action objects
-            # Software are defined in STIX as malware objects
-            stix_results = filter_by_type_and_id(ds, type_filter, relationship.source_ref, source_name)
+            stix_object = objects_by_id.get(relationship.source_ref)
 
-            if stix_results:
-                row_data = (
+            if stix_object:
+                yield attack_pattern, (
                     grab_external_id(attack_pattern, source_name),
                     attack_pattern.name,
-                    grab_external_id(stix_results[0], source_name),
-                    stix_results[0].name,
-                    escape_chars(stix_results[0].description),
+                    grab_external_id(stix_object, source_name),
+                    stix_object.name,
+                    escape_chars(stix_object.description),
                     escape_chars(relationship.description),
                 )
 
-                writable_results.append(dict(zip(fieldnames, row_data)))
+
+def sorted_mappings(attack_patterns, relationships_by_target, objects_by_id, source_name, desc="parsing data for techniques"):
+    """Joins techniques to the mapped objects like join_mappings, but yields the mappings already sorted by (TID, xID).
+
+    The techniques are joined in ATT&CK ID order, so only the mappings of the techniques sharing one ATT&CK ID are held
+    in memory to be sorted, however many rows there are."""
+    attack_patterns = sorted(attack_patterns, key=lambda attack_pattern: grab_external_id(attack_pattern, source_name))
+    mappings = join_mappings(tqdm.tqdm(attack_patterns, desc=desc), relationships_by_target, objects_by_id, source_name)
+    for _, technique_mappings in itertools.groupby(mappings, key=lambda mapping: mapping[1][0]):
+        yield from sorted(technique_mappings, key=lambda mapping: mapping[1][2])
+
+
+def tactics_by_technique(attack_patterns):
+    """Maps the id of each technique to the names of its tactics, which come from its kill chain phases"""
+    return {
+        attack_pattern.id: list(dict.fromkeys(phase["phase_name"] for phase in attack_pattern.get("kill_chain_phases", [])))
+        for attack_pattern in attack_patterns
+    }
+
+
+def do_mapping(ds, fieldnames, relationship_type, type_filter, source_name, sorting_keys, tactic=None):
+    """Main logic to map techniques to mitigations, groups or software"""
+    all_attack_patterns = get_all_techniques(ds, source_name, tactic)
+    # Index the relationships and the mapped objects once, then join them to the techniques by id
+    relationships_by_target = index_relationships_by_target(ds, relationship_type)
+    # Groups are defined in STIX as intrusion-set objects
+    # Mitigations are defined in STIX as course-of-action objects
+    # Software are defined in STIX as malware and tool objects
+    objects_by_id = index_objects_by_id(ds, type_filter, source_name)
+    writable_results = []
+
+    mappings = join_mappings(tqdm.tqdm(all_attack_patterns, desc="parsing data for techniques"), relationships_by_target, objects_by_id, source_name)
+    for _, row_data in mappings:
+        writable_results.append(dict(zip(fieldnames, row_data)))
 
     return sorted(writable_results, key=lambda x: (x[sorting_keys[0]], x[sorting_keys[1]]))
 
 
+def do_batch_mapping(ds, source_name, mapping_types, tactics=None):
+    """Maps techniques to each of the mapping types, for all techniques and for each tactic, with one pass over the techniques per mapping type.
+
+    Returns a dict of (mapping type, tactic) -> sorted row dicts, where the tactic is None for the mapping of all techniques.
+    If no tactics are given, every tactic of the techniques is output."""
+    all_attack_patterns = get_all_techniques(ds, source_name)
+    technique_tactics = tactics_by_technique(all_attack_patterns)
+    if not tactics:
+        tactics = list(dict.fromkeys(tactic for phase_names in technique_tactics.values() for tactic in phase_names))
+
+    results = {}
+    for mapping_type in mapping_types:
+        config = mapping_configs[mapping_type]
+        relationships_by_target = index_relationships_by_target(ds, config["relationship_type"])
+        objects_by_id = index_objects_by_id(ds, config["type_filter"], source_name)
+        partitions = {tactic: [] for tactic in [None] + list(tactics)}
+
+        mappings = join_mappings(tqdm.tqdm(all_attack_patterns, desc="parsing data for " + mapping_type), relationships_by_target, objects_by_id, source_name)
+        for attack_pattern, row_data in mappings:
+            rowdict = dict(zip(config["fieldnames"], row_data))
+            partitions[None].append(rowdict)
+            # Partition the row by the tactics of its technique
+            for tactic in technique_tactics[attack_pattern.id]:
+                if tactic in partitions:
+                    partitions[tactic].append(rowdict)
+
+        sorting_keys = config["sorting_keys"]
+        for tactic, rowdicts in partitions.items():
+            results[(mapping_type, tactic)] = sorted(rowdicts, key=lambda x: (x[sorting_keys[0]], x[sorting_keys[1]]))
+
+    return results
+
+
+def do_streaming_mapping(ds, relationship_type, type_filter, source_name, tactic=None):
+    """Like do_mapping, but yields the rows as tuples as they're joined, sorted by (TID, xID), instead of returning a list of them"""
+    all_attack_patterns = get_all_techniques(ds, source_name, tactic)
+    relationships_by_target = index_relationships_by_target(ds, relationship_type)
+    objects_by_id = index_objects_by_id(ds, type_filter, source_name)
+    for _, row_data in sorted_mappings(all_attack_patterns, relationships_by_target, objects_by_id, source_name):
+        yield row_data
+
+
+def write_streaming_batch_mapping(ds, source_name, mapping_types, output_dir, tactics=None):
+    """Like do_batch_mapping, but writes the rows to the CSV files of output_dir as they're joined instead of returning them.
+
+    The rows of each tactic are a subsequence of the rows for all techniques, so all the files of a mapping type are
+    written at the same time, from one sorted pass over the techniques."""
+    all_attack_patterns = get_all_techniques(ds, source_name)
+    technique_tactics = tactics_by_technique(all_attack_patterns)
+    if not tactics:
+        tactics = list(dict.fromkeys(tactic for phase_names in technique_tactics.values() for tactic in phase_names))
+
+    for mapping_type in mapping_types:
+        config = mapping_configs[mapping_type]
+        relationships_by_target = index_relationships_by_target(ds, config["relationship_type"])
+        objects_by_id = index_objects_by_id(ds, config["type_filter"], source_name)
+
+        with contextlib.ExitStack() as stack:
+            writers = {}
+            for tactic in [None] + list(tactics):
+                filename = config["filename"] if tactic is None else "%s_%s.csv" % (mapping_type, tactic)
+                csvfile = stack.enter_context(io.open(os.path.join(output_dir, filename), "w", newline="", encoding="utf-8"))
+                writers[tactic] = csv.writer(csvfile)
+                writers[tactic].writerow(config["fieldnames"])
+
+            mappings = sorted_mappings(all_attack_patterns, relationships_by_target, objects_by_id, source_name, "parsing data for " + mapping_type)
+            for attack_pattern, row_data in mappings:
+                writers[None].writerow(row_data)
+                # Partition the row by the tactics of its technique
+                for tactic in technique_tactics[attack_pattern.id]:
+                    if tactic in writers:
+                        writers[tactic].writerow(row_data)
+
+
+def write_mapping_rows(filename, fieldnames, rows):
+    """Writes mapping rows given as tuples to a CSV file as they're generated"""
+    with io.open(filename, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
+
+
+def write_mapping(filename, fieldnames, rowdicts):
+    """Writes the mapping rows to a CSV file"""
+    with io.open(filename, "w", newline="", encoding="utf-8") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rowdicts)
+
+
 def main(args):
     data_source = build_taxii_source(args.domain)
     op = args.mapping_type
@@ -137,38 +282,39 @@ def main(args):
         "mobile_attack": "mitre-mobile-attack",
     }
     source_name = source_map[args.domain]
-    tactic = args.tactic
-    if op == "groups":
-        filename = args.save or "groups.csv"
-        fieldnames = ("TID", "Technique Name", "GID", "Group Name", "Group Description", "Usage")
-        relationship_type = "uses"
-        type_filter = "intrusion-set"
-        sorting_keys = ("TID", "GID")
-        rowdicts = do_mapping(data_source, fieldnames, relationship_type, type_filter, source_name, sorting_keys, tactic)
-    elif op == "mitigations":
-        filename = args.save or "mitigations.csv"
-        fieldnames = ("TID", "Technique Name", "MID", "Mitigation Name", "Mitigation Description", "Application")
-        relationship_type = "mitigates"
-        type_filter = "course-of-action"
-        sorting_keys = ("TID", "MID")
-        rowdicts = do_mapping(data_source, fieldnames, relationship_type, type_filter, source_name, sorting_keys, tactic)
-    elif op == "software":
-        filename = args.save or "software.csv"
-        fieldnames = ("TID", "Technique Name", "SID", "Software Name", "Software Description", "Use")
-        relationship_type = "uses"
-        type_filter = "malware"
-        sorting_keys = ("TID", "SID")
-        rowdicts = do_mapping(data_source, fieldnames, relationship_type, type_filter, source_name, sorting_keys, tactic)
-    else:
-        raise RuntimeError("Unknown option: %s" % op)
 
-    with io.open(filename, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rowdicts)
+    if args.batch and args.low_memory:
+        os.makedirs(args.output_dir, exist_ok=True)
+        write_streaming_batch_mapping(data_source, source_name, list(mapping_configs), args.output_dir, args.tactics)
+        return
+    if args.batch:
+        os.makedirs(args.output_dir, exist_ok=True)
+        results = do_batch_mapping(data_source, source_name, list(mapping_configs), args.tactics)
+        for (mapping_type, tactic), rowdicts in results.items():
+            config = mapping_configs[mapping_type]
+            filename = config["filename"] if tactic is None else "%s_%s.csv" % (mapping_type, tactic)
+            write_mapping(os.path.join(args.output_dir, filename), config["fieldnames"], rowdicts)
+        return
+
+    if op not in mapping_configs:
+        raise RuntimeError("Unknown option: %s" % op)
+    config = mapping_configs[op]
+    filename = args.save or config["filename"]
+    if args.low_memory:
+        rows = do_streaming_mapping(data_source, config["relationship_type"], config["type_filter"], source_name, args.tactic)
+        write_mapping_rows(filename, config["fieldnames"], rows)
+        return
+    rowdicts = do_mapping(data_source, config["fieldnames"], config["relationship_type"], config["type_filter"], source_name, config["sorting_keys"], args.tactic)
+    write_mapping(filename, config["fieldnames"], rowdicts)
 
 
 if __name__ == "__main__":
     parser = arg_parse()
     args = parser.parse_args()
+    if args.batch and (args.mapping_type or args.tactic or args.save):
+        parser.error("--batch cannot be used with --mapping-type, --tactic or --save")
+    if not args.batch and not args.mapping_type:
+        parser.error("--mapping-type is required unless --batch is used")
+    if args.tactics and not args.batch:
+        parser.error("--tactics can only be used with --batch")
     main(args)
@@ -1,81 +1,81 @@
-import json, os, shutil, sys
-from stix2 import TAXIICollectionSource, Filter
+import contextlib, csv, json, os, shutil, sys, uuid
+from concurrent.futures import ThreadPoolExecutor
+from stix2 import TAXIICollectionSource
 from taxii2client.v20 import Collection
 from pprint import pprint
 import argparse
-from tqdm import tqdm
 from tabulate import tabulate
 
 # if verbose is set to True, additional processing logs will be printed to stdout
 verbose = False
 
-######## MAPS FOR TECHNIQUES #########
-# technique name (string) -> STIX ID (string)
-tech_to_id={}
-# technique name (string) -> data sources (array of strings)
-tech_to_data={}
-# technique name (string) -> tactics (array of strings)
-tech_to_tac={}
-# technique name (string) -> permissions (array of strings)
-# Note: sometimes empty
-tech_to_perm={}
-# technique name (string) -> platforms (array of strings)
-tech_to_plat={}
-# technique name (string) -> defenses evaded (array of strings)
-# Note: sometimes empty
-tech_to_def={}
-# technique name (string) -> software (array of strings)
-tech_to_software={}
-# technique name (string) -> group (array of strings)
-tech_to_group={}
-
-######## MAPS FOR SOFTWARE ###########
-# software name (string) -> STIX ID (string)
-software_to_id={}
-# software name (string) -> techniques (array of strings)
-software_to_tech={}
-# software name (string) -> groups (array of strings)
-software_to_group={}
-
-######## MAPS FOR GROUPS ############
-# group name (string) -> STIX ID (string)
-group_to_id={}
-# group name (string) -> techniques (array of strings)
-group_to_tech={}
-# group name (string) -> software (array of strings)
-group_to_software={}
-
-######## MAPS FOR IDS ###############
-# STIX ID (string) -> technique name (string)
-id_to_tech={}
-# STIX ID (string) -> software name (string)
-id_to_software={}
-# STIX ID (string) -> group name (string)
-id_to_group={}
-
-######## OTHER MAPS #################
-# tactics (string) -> permissions (dictionary: permission string -> count integer)
-tactics_to_permission={}
-
-
-def add_link(alpha, beta, alpha_dict, beta_dict):
-    """helper function for parsing relationships.
-    
-    arguments:
-        alpha: string, the first item in the relationship
-        beta:  string, the second item in the relationship
-        alpha_dict: dict, the data structure for storing items of the same type as alpha
-        beta_dict:  dict, the data structure for storing items of the same type as beta
+class Graph(object):
+    """a graph of techniques, software and groups, and of the tactics, platforms, data sources, defenses and permissions of the techniques.
+
+    nodes are typed and interned: each (node type, name) pair gets an integer node id the first time it's added, and the
+    techniques, software and groups are also indexed by STIX ID. links are undirected and deduplicated. adjacency is stored
+    per node and per neighbor type in dicts used as ordered sets, so adding a link and checking for one take constant time
+    and neighbors are listed in the order they were linked.
     """
-    
-    if alpha not in alpha_dict:
-        alpha_dict[alpha]=[]
-    if beta not in beta_dict:
-        beta_dict[beta]=[]
-    if alpha not in beta_dict[beta]:
-        beta_dict[beta].append(alpha)
-    if beta not in alpha_dict[alpha]:
-        alpha_dict[alpha].append(beta)
+
+    def __init__(self):
+        self.node_ids = {} # (node type, name) -> node id
+        self.node_types = [] # node id -> node type
+        self.names = [] # node id -> name
+        self.lower_names = [] # node id -> lowercased name, as written to the output
+        self.type_to_nodes = {} # node type -> ordered set of node ids
+        self.stix_id_to_node = {} # STIX ID -> node id
+        self.adjacency = [] # node id -> neighbor type -> ordered set of neighbor node ids
+
+    def add_node(self, node_type, name):
+        """return the node id of the given node, adding it if it isn't in the graph yet."""
+
+        key = (node_type, name)
+        if key not in self.node_ids:
+            self.node_ids[key] = len(self.names)
+            self.node_types.append(node_type)
+            self.names.append(name)
+            self.lower_names.append(name.lower())
+            self.adjacency.append({})
+            self.type_to_nodes.setdefault(node_type, {})[self.node_ids[key]] = None
+        return self.node_ids[key]
+
+    def node(self, node_type, name):
+        """return the node id of the given node, or None if it isn't in the graph."""
+
+        return self.node_ids.get((node_type, name))
+
+    def link(self, alpha, beta):
+        """link two nodes. Linking nodes which are already linked does nothing.
+
+        arguments:
+            alpha: int, the node id of the first item in the relationship
+            beta:  int, the node id of the second item in the relationship
+        """
+
+        self.adjacency[alpha].setdefault(self.node_types[beta], {})[beta] = None
+        self.adjacency[beta].setdefault(self.node_types[alpha], {})[alpha] = None
+
+    def unlink(self, alpha, beta):
+        """remove the link between two nodes, if there is one."""
+
+        self.adjacency[alpha].get(self.node_types[beta], {}).pop(beta, None)
+        self.adjacency[beta].get(self.node_types[alpha], {}).pop(alpha, None)
+
+    def nodes(self, node_type):
+        """return the node ids of the given type, in the order they were added."""
+
+        return self.type_to_nodes.get(node_type, {}).keys()
+
+    def neighbors(self, node, node_type):
+        """return the node ids of the neighbors of the given type of a node, in the order they were linked."""
+
+        return self.adjacency[node].get(node_type, {}).keys()
+
+    def degree(self, node, node_type):
+        """return the number of neighbors of the given type of a node."""
+
+        return len(self.adjacency[node].get(node_type, {}))
 
 
 def makelower(indict):
@@ -102,144 +102,137 @@ def establish_connection(collection: str):
     return tc_src
 
 
-def parse_tactics():
-    """creates mappings from tactics to permissions. Requires that the technique dictionaries have been loaded already; see parse_techniques."""
-    
+def parse_tactics(graph):
+    """count the techniques in each tactic that require each permission. Requires that the techniques have been parsed already; see parse_techniques.
+
+    arguments:
+        graph: Graph containing the techniques
+
+    returns:
+        dict of tactic name -> (dict of permission name -> count of techniques)
+    """
+
+    tactics_to_permission={}
     # Iterate over each technique
-    for tech in tech_to_tac:
+    for tech in graph.nodes("technique"):
         # Iterate over each tactic
-        for tac in tech_to_tac[tech]:
+        for tac in graph.neighbors(tech, "tactic"):
             # Initialize this one, if it hasn't already been
-            if tac not in tactics_to_permission:
-                tactics_to_permission[tac]={}
+            if graph.names[tac] not in tactics_to_permission:
+                tactics_to_permission[graph.names[tac]]={}
+            permissions = tactics_to_permission[graph.names[tac]]
             # Now iterate over each permission
-            for perm in tech_to_perm[tech]:
-                if perm not in tactics_to_permission[tac]:
-                    tactics_to_permission[tac][perm]=0
-                tactics_to_permission[tac][perm]=tactics_to_permission[tac][perm] + 1
+            for perm in graph.neighbors(tech, "permission"):
+                permissions[graph.names[perm]] = permissions.get(graph.names[perm], 0) + 1
+    return tactics_to_permission
 
 
-def parse_software(software_set):
-    """parse stix software into appropriate data structures.
+def parse_software(graph, software_set):
+    """parse stix software into the graph.
 
     arguments:
+        graph: Graph to add the software to
         software_set: list of stix-formatted software dicts
     """
 
     for entry in software_set:
-        name=entry['name']
-        cur_id=entry['id']
-        if name not in software_to_id:
-            software_to_id[name]=cur_id
-            id_to_software[cur_id]=name
+        # only the first software with a given name is indexed by STIX ID
+        if graph.node("software", entry['name']) is None:
+            graph.stix_id_to_node[entry['id']] = graph.add_node("software", entry['name'])
 
 
-def parse_groups(group_set):
-    """parse stix groups into appropriate data structures.
+def parse_groups(graph, group_set):
+    """parse stix groups into the graph.
 
     arguments:
+        graph: Graph to add the groups to
         group_set: list of stix-formatted group dicts
     """
 
     for entry in group_set:
-        name=entry['name']
-        cur_id=entry['id']
-        if name not in group_to_id:
-            group_to_id[name]=cur_id
-            id_to_group[cur_id]=name
+        # only the first group with a given name is indexed by STIX ID
+        if graph.node("group", entry['name']) is None:
+            graph.stix_id_to_node[entry['id']] = graph.add_node("group", entry['name'])
 
 
-def parse_relationships(relationships):
-    """parse stix relationships into appropriate data structures.
+def parse_relationships(graph, relationships):
+    """parse stix relationships into links between the techniques, software and groups of the graph.
 
     arguments:
+        graph: Graph containing the techniques, software and groups
         relationships: list of stix-formatted relationship dicts
     """
 
     # Iterate over each relationship
     for obj in relationships:
-        # Load the source and target STIX IDs
-        src=obj['source_ref']
-        tgt=obj['target_ref']
-        # Handle each case
-        if src in id_to_tech and tgt in id_to_group:
-            add_link(id_to_tech[src], id_to_group[tgt], tech_to_group, group_to_tech)
-        if src in id_to_tech and tgt in id_to_software:
-            add_link(id_to_tech[src], id_to_software[tgt], tech_to_software, software_to_tech)
-        if src in id_to_software and tgt in id_to_group:
-            add_link(id_to_software[src], id_to_group[tgt], software_to_group, group_to_software)
-        if src in id_to_software and tgt in id_to_tech:
-            add_link(id_to_software[src], id_to_tech[tgt], software_to_tech, tech_to_software)
-        if src in id_to_group and tgt in id_to_tech:
-            add_link(id_to_group[src], id_to_tech[tgt], group_to_tech, tech_to_group)
-        if src in id_to_group and tgt in id_to_software:
-            add_link(id_to_group[src], id_to_software[tgt], group_to_software, software_to_group)
-
-
-def parse_techniques(techniques):
-    """parse stix techniques into appropriate data structures.
+        # Look up the nodes of the source and target STIX IDs
+        src=graph.stix_id_to_node.get(obj['source_ref'])
+        tgt=graph.stix_id_to_node.get(obj['target_ref'])
+        # Link techniques, software and groups to each other, but not to objects of the same type
+        if src is not None and tgt is not None and graph.node_types[src] != graph.node_types[tgt]:
+            graph.link(src, tgt)
+
+
+def parse_techniques(graph, techniques):
+    """parse stix techniques into the graph.
 
     arguments:
+        graph: Graph to add the techniques to
         techniques: list of stix-formatted technique dicts
     """
 
+    # the node type and stix field of each of the lists of a technique
+    technique_fields = [
+        ("platform", 'x_mitre_platforms'), # the platforms the technique applies to
+        ("data source", 'x_mitre_data_sources'), # the data sources we can monitor to detect the technique
+        ("defense", 'x_mitre_defense_bypassed'), # the defenses the technique bypasses
+        ("permission", 'x_mitre_permissions_required') # the permissions required to execute the technique
+    ]
     # Iterate over each technique object
     for obj in techniques:
-        # Easy-access the technique's name
-        tech=obj['name']
-        # Go through each technique dictionary global
-        # If we haven't seen this technique before, we need to initialize the array
-        if tech not in tech_to_data:
-            tech_to_data[tech]=[]
-        if tech not in tech_to_tac:
-            tech_to_tac[tech]=[]
-        if tech not in tech_to_perm:
-            tech_to_perm[tech]=[]
-        if tech not in tech_to_plat:
-            tech_to_plat[tech]=[]
-        if tech not in tech_to_def:
-            tech_to_def[tech]=[]
+        tech=graph.add_node("technique", obj['name'])
         # Store the ID number
         if 'id' in obj:
-            tech_to_id[tech]=obj['id']
-            id_to_tech[obj['id']]=tech
+            graph.stix_id_to_node[obj['id']]=tech
         # Store the tactics
         if 'kill_chain_phases' in obj:
             for pair in obj['kill_chain_phases']:
                 if 'phase_name' in pair:
-                    tac=pair['phase_name']
-                    if tac not in tech_to_tac[tech]:
-                        tech_to_tac[tech].append(tac)
-        # Store the platforms the technique applies to
-        if 'x_mitre_platforms' in obj:
-            for plat in obj['x_mitre_platforms']:
-                if plat not in tech_to_plat[tech]:
-                    tech_to_plat[tech].append(plat)
-        # Store the data sources we can monitor to detect the technique
-        if 'x_mitre_data_sources' in obj:
-            for src in obj['x_mitre_data_sources']:
-                if src not in tech_to_data[tech]:
-                    tech_to_data[tech].append(src)
-        # Store the defenses the technique bypasses
-        if 'x_mitre_defense_bypassed' in obj:
-            for defb in obj['x_mitre_defense_bypassed']:
-                if defb not in tech_to_def[tech]:
-                    tech_to_def[tech].append(defb)
-        # Store the permissions required to execute the technique
-        if 'x_mitre_permissions_required' in obj:
-            for perm in obj['x_mitre_permissions_required']:
-                if perm not in tech_to_perm[tech]:
-                    tech_to_perm[tech].append(perm)
+                    graph.link(tech, graph.add_node("tactic", pair['phase_name']))
+        for node_type, field in technique_fields:
+            for value in obj.get(field, []):
+                graph.link(tech, graph.add_node(node_type, value))
 
     # As a note: sometimes permissions required lists user + root permissions
     # This code below makes sure only User is listed as a permission if it's a required permission
     # (rationale: if a technique requires user permission, it stands to reason you can run it as Administrator/SYSTEM/root)
-    for tech in tech_to_perm:
-        if 'User' in tech_to_perm[tech]:
-            tech_to_perm[tech]=['User']
+    user = graph.node("permission", 'User')
+    if user is not None:
+        for tech in graph.neighbors(user, "technique"):
+            for perm in list(graph.neighbors(tech, "permission")):
+                if perm != user:
+                    graph.unlink(tech, perm)
+
+
+@contextlib.contextmanager
+def csv_writer(output_directory, filename):
+    """open a buffered csv writer for an output file.
 
+    arguments:
+        output_directory: string. The folder the output file will be written to. The folder will be created if it doesn't already exist.
+        filename: string, the name of the output file
+
+    returns:
+        context manager yielding the csv.writer of the file
+    """
 
-def write_DPT(output_directory):
+    # Make sure the directory exists
+    os.makedirs(output_directory, exist_ok=True)
+    with open(os.path.join(output_directory, filename), "w", newline="", buffering=1 << 20) as output_file:
+        yield csv.writer(output_file, lineterminator="\n")
+
+
+def write_DPT(graph, output_directory):
     """writes a CSV that links techniques, defenses, permissions, and tactics.
     
     specifically, the output will link:
@@ -249,43 +242,118 @@ def write_DPT(output_directory):
         repeated for each defense and tactic that is linked to the technique
 
     arguments:
+        graph: Graph of the parsed content
         output_directory: string. The folder the output data will be written to. The folder will be created if it doesn't already exist.
     """
 
 
-    output_file = os.path.join(output_directory, "dpt.csv")
-    # Make sure the directory exists
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    with open (output_file, "w") as output_file:
+    lower = graph.lower_names
+    with csv_writer(output_directory, "dpt.csv") as writer:
         # Write the header of the CSV
-        output_file.write("tech,defense,permission\n")
+        writer.writerow(("tech", "defense", "permission"))
         # Iterate through each technique, defense, and permission
-        for tech in tech_to_def:
-            for defn in tech_to_def[tech]:
-                for perm in tech_to_perm[tech]:
-                    output_file.write(tech.lower() + "," + defn.lower() + "," + perm.lower() + "\n")
+        for tech in graph.nodes("technique"):
+            for defn in graph.neighbors(tech, "defense"):
+                writer.writerows((lower[tech], lower[defn], lower[perm]) for perm in graph.neighbors(tech, "permission"))
 
 
-def write_tacticsToTechniques(output_directory="generated_content"):
+def write_tacticsToTechniques(graph, output_directory="generated_content"):
     """write a csv linking tactics to techniques.
     
     arguments:
+        graph: Graph of the parsed content
         output_directory: string. The folder the output data will be written to. The folder will be created if it doesn't already exist.
     """
-    output_file = os.path.join(output_directory, "tacticsToTechniques.csv")
-    # Make sure the directory exists
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    with open (output_file, "w") as output_file:
+    lower = graph.lower_names
+    with csv_writer(output_directory, "tacticsToTechniques.csv") as writer:
         # Write the header of the CSV
-        output_file.write("technique,tactic\n")
-        for tech in tech_to_tac:
-            for tac in tech_to_tac[tech]:
-                output_file.write(tech.lower() + "," + tac.lower() + "\n")
+        writer.writerow(("technique", "tactic"))
+        for tech in graph.nodes("technique"):
+            writer.writerows((lower[tech], lower[tac]) for tac in graph.neighbors(tech, "tactic"))
+
+
+# the columns of each aggregated tsg output: the columns that are kept, and the column whose distinct values are counted
+tsgAggregates = {
+    "group": (("technique", "group"), "software"),
+    "software": (("technique", "software"), "group")
+}
+
+
+def desired_techniques(graph, specified_techniques=None):
+    """return the node ids of the techniques to link in the tsg output.
+
+    arguments:
+        graph: Graph of the parsed content
+        specified_techniques: string[] of technique names. If this argument is not specified all techniques are returned.
+    """
+
+    if specified_techniques is None: return list(graph.nodes("technique"))
+    specified_techniques = set(specified_techniques)
+    return [tech for tech in graph.nodes("technique") if graph.names[tech] in specified_techniques]
+
+
+def estimate_TSG_rows(graph, specified_techniques=None, aggregate=None):
+    """estimate the number of rows write_TSG would write, from the degrees of the nodes and without writing anything.
+
+    for the full output this is exact. For an aggregated output it's an upper bound, since a group using several
+    software which implement the same technique is only counted once.
+
+    arguments:
+        graph: Graph of the parsed content
+        specified_techniques: string[] of techniques to link. See write_TSG.
+        aggregate: optional string, one of the keys of tsgAggregates. See write_TSG.
 
+    returns:
+        int, the estimated number of rows, not counting the header
+    """
+
+    rows = 0
+    for tech in desired_techniques(graph, specified_techniques):
+        if aggregate == "software":
+            rows += graph.degree(tech, "software")
+        else:
+            rows += sum(graph.degree(software, "group") for software in graph.neighbors(tech, "software"))
+    return rows
+
+
+def tsg_rows(graph, specified_techniques=None):
+    """generate the (technique, software, group) rows of the tsg output, lowercased.
+
+    arguments:
+        graph: Graph of the parsed content
+        specified_techniques: string[] of techniques to link. See write_TSG.
+    """
+
+    for tech in desired_techniques(graph, specified_techniques):
+        for software in graph.neighbors(tech, "software"):
+            # Some software may not be used by groups, in which case it has no group neighbors
+            for group in graph.neighbors(software, "group"):
+                yield graph.lower_names[tech], graph.lower_names[software], graph.lower_names[group]
+
+
+def aggregated_tsg_rows(graph, aggregate, specified_techniques=None):
+    """generate the rows of an aggregated tsg output: the kept columns followed by the count of the distinct values of the counted column.
+
+    arguments:
+        graph: Graph of the parsed content
+        aggregate: string, one of the keys of tsgAggregates
+        specified_techniques: string[] of techniques to link. See write_TSG.
+    """
 
-def write_TSG(specified_techniques=None, output_directory="generated_content"):
+    for tech in desired_techniques(graph, specified_techniques):
+        counts = {}
+        for software in graph.neighbors(tech, "software"):
+            if aggregate == "software":
+                counts[software] = graph.degree(software, "group")
+            else:
+                for group in graph.neighbors(software, "group"):
+                    counts[group] = counts.get(group, 0) + 1
+        for node, count in counts.items():
+            # software used by no groups is left out, like it is in the full output
+            if count: yield graph.lower_names[tech], graph.lower_names[node], count
+
+
+def write_TSG(graph, specified_techniques=None, output_directory="generated_content", aggregate=None):
     """write a csv linking techniques, software and groups.
     
     specifically, the output will link:
@@ -293,135 +361,185 @@ def write_TSG(specified_techniques=None, output_directory="generated_content"):
         software implementing those techniques, to
         groups using the software
 
+    the full output has a row for each of these triples. It's written as it's generated, so it's never held in memory,
+    but it can still get very large; use estimate_TSG_rows to find out how large before writing it. The aggregated
+    outputs are much smaller: with aggregate "group" there's a row for each technique and group with the number of
+    software linking them, and with aggregate "software" a row for each technique and software with the number of groups
+    using the software.
+
     arguments:
+        graph: Graph of the parsed content
         specified_techniques: string[] of techniques to link. All other techniques will be ignored. If this argument is not specified 
                               it will output all techniques.
         output_directory: string. The folder the output data will be written to. The folder will be created if it doesn't already exist.
+        aggregate: optional string, one of the keys of tsgAggregates. If specified, the aggregated output is written instead of the full output.
     """
 
-    filename = "tsg_subset.csv" if specified_techniques is not None else "tsg.csv"
-    output_file = os.path.join(output_directory, filename)
-    # Make sure the directory exists
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    with open (output_file, "w") as output_file:
+    filename = "tsg_subset" if specified_techniques is not None else "tsg"
+    if aggregate: filename += "_by_" + aggregate
+    with csv_writer(output_directory, filename + ".csv") as writer:
         # Write the header of the CSV
-        output_file.write("technique,software,group\n")
-        # only process techniques we want to output
-        # if we don't specify any desired techniques, all techniques will be processed
-        desired_techniques = list(filter(lambda t: specified_techniques is None or t in specified_techniques, tech_to_software))
-        for tech in desired_techniques:
-            for software in tech_to_software[tech]:
-                # Some software may not be used by groups
-                if software not in software_to_group:
-                    continue
-                for group in software_to_group[software]:
-                    output_file.write(tech.lower() + "," + software.lower() + "," + group.lower() + "\n")
-
-
-def write_tacticPermissions(output_directory="generated_content"):
+        if aggregate:
+            columns, counted = tsgAggregates[aggregate]
+            writer.writerow(columns + (counted + " count",))
+            writer.writerows(aggregated_tsg_rows(graph, aggregate, specified_techniques))
+        else:
+            writer.writerow(("technique", "software", "group"))
+            writer.writerows(tsg_rows(graph, specified_techniques))
+
+
+def write_tacticPermissions(graph, output_directory="generated_content"):
     """write a CSV showing the number of techniques in a tactic that require a minimum permission.
 
     arguments:
+        graph: Graph of the parsed content
         output_directory: string. The folder the output data will be written to. The folder will be created if it doesn't already exist.
     """
 
-    output_file = os.path.join(output_directory, "tacticPermissions.csv")
-    # Make sure the directory exists
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    with open (output_file, "w") as output_file:
+    tactics_to_permission = parse_tactics(graph)
+    with csv_writer(output_directory, "tacticPermissions.csv") as writer:
         # Write the header of the CSV
-        output_file.write("tactic,permission,technique count\n")
+        writer.writerow(("tactic", "permission", "technique count"))
         for tac in tactics_to_permission:
             for perm in tactics_to_permission[tac]:
-                output_file.write(tac.lower() + "," + perm.lower() + "," + str(tactics_to_permission[tac][perm]) + "\n")
+                writer.writerow((tac.lower(), perm.lower(), tactics_to_permission[tac][perm]))
 
 
-def write_techniquesToDatasources(data_sources, output_directory="generated_content"):
+def write_techniquesToDatasources(graph, data_sources, output_directory="generated_content"):
     """write a CSV linking techniques to the data sources that can potentially detect those techniques.
 
     arguments:
+        graph: Graph of the parsed content
         data_sources: string[] of datasource names. The output will be filtered according to this list.
         output_directory: string. The folder the output data will be written to. The folder will be created if it doesn't already exist.
     """
 
-    output_file = os.path.join(output_directory, "techniques_datasources.csv")
-    # make sure the directory exists
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-    with open (output_file, "w") as output_file:
+    lower = graph.lower_names
+    data_sources = set(data_sources)
+    with csv_writer(output_directory, "techniques_datasources.csv") as writer:
         # Write the header of the CSV
-        output_file.write("technique,data source\n")
-        for tech in tech_to_data:
-            for data in tech_to_data[tech]:
-                if data.lower() in data_sources:
-                    output_file.write(tech.lower() + "," + data.lower() + "\n")
+        writer.writerow(("technique", "data source"))
+        for tech in graph.nodes("technique"):
+            writer.writerows((lower[tech], lower[data]) for data in graph.neighbors(tech, "data source") if lower[data] in data_sources)
+
+
+def write_outputs(writers, workers=None):
+    """run output writers concurrently in a thread pool.
+
+    arguments:
+        writers: list of (write function, tuple of arguments) pairs
+        workers: optional int, the number of threads. Defaults to one for each writer.
+    """
+
+    with ThreadPoolExecutor(max_workers=workers or len(writers)) as executor:
+        futures = [executor.submit(write, *args) for write, args in writers]
+        # re-raise any error from the writers
+        for future in futures: future.result()
 
 
-def generate_content(data_sources_list, tactics_to_visualize, output_directory="generated_content"):
+def retrieve_objects(bundle_file=None):
+    """retrieve the Enterprise ATT&CK objects and partition them by type.
+
+    the collection is fetched from the TAXII server with a single query rather than one query per type. If bundle_file
+    is given and exists the objects are loaded from it instead, and if it doesn't exist yet the fetched objects are saved
+    to it, so later runs can work offline.
+
+    arguments:
+        bundle_file: optional string, the path of a local STIX bundle file of the Enterprise ATT&CK collection
+
+    returns:
+        dict of stix type -> list of stix objects of that type
+    """
+
+    if bundle_file and os.path.exists(bundle_file):
+        if verbose: print("loading data from " + bundle_file + "... ", end="", flush=True)
+        with open(bundle_file, "r") as f:
+            objects = json.load(f)["objects"]
+    else:
+        # establish the connection to the TAXII server
+        if verbose: print("establishing connection... ", end="", flush=True)
+        tc_src = establish_connection("https://cti-taxii.mitre.org/stix/collections/95ecc380-afe9-11e4-9b6c-751b66dd541e/")
+        if verbose: print("done!")
+
+        if verbose: print("retrieving data... ", end="", flush=True)
+        objects = tc_src.query()
+        if bundle_file:
+            objects = [json.loads(obj.serialize()) if hasattr(obj, "serialize") else obj for obj in objects]
+            if os.path.dirname(bundle_file) and not os.path.exists(os.path.dirname(bundle_file)):
+                os.makedirs(os.path.dirname(bundle_file))
+            with open(bundle_file, "w") as f:
+                json.dump({"type": "bundle", "id": "bundle--" + str(uuid.uuid4()), "spec_version": "2.0", "objects": objects}, f)
+    if verbose: print("done!")
+
+    # partition the objects by type in one pass
+    objects_by_type = {}
+    for obj in objects:
+        objects_by_type.setdefault(obj["type"], []).append(obj)
+    return objects_by_type
+
+
+def generate_content(data_sources_list, tactics_to_visualize, output_directory="generated_content", bundle_file=None, tsg_aggregate=None, dry_run=False):
     """download, parse and write content to csv.
 
     arguments:
         data_sources_list: string[] of datasource names. techniques_datasources.csv will be filtered according to this list
         tactics_to_visualize: string[] of tactic names. tsg_subset.csv will be filtered according to this list
         output_directory: string. The folder the output data will be written to. The folder will be created if it doesn't already exist.
+        bundle_file: optional string, the path of a local STIX bundle file to use instead of the TAXII server. See retrieve_objects.
+        tsg_aggregate: optional string, one of the keys of tsgAggregates. If specified, the tsg outputs are aggregated. See write_TSG.
+        dry_run: if true, print the estimated number of rows of the tsg outputs instead of writing any output.
+
+    returns:
+        the Graph of the parsed content
     """
 
-    # establish the connection to the TAXII server
-    if verbose: print("establishing connection... ", end="", flush=True)
-    tc_src = establish_connection("https://cti-taxii.mitre.org/stix/collections/95ecc380-afe9-11e4-9b6c-751b66dd541e/")
-    if verbose: print("done!")
+    objects_by_type = retrieve_objects(bundle_file)
+    techniques = objects_by_type.get("attack-pattern", [])
+    tools_set = objects_by_type.get("tool", [])
+    malwares = objects_by_type.get("malware", [])
+    intrusion_sets = objects_by_type.get("intrusion-set", [])
+    relationships = objects_by_type.get("relationship", [])
 
-    # Get all techniques in Enterprise ATT&CK
-    # use tqdm progress bar if verbose mode is enabled
-    if verbose: pbar = tqdm(total=5, desc="retrieving data", bar_format="{desc} |{bar}| {percentage:3.0f}%  ", ncols=35)
-    techniques = tc_src.query([Filter("type", "=", "attack-pattern")])
-    if verbose: pbar.update(1)
-    tools_set = tc_src.query([Filter("type", "=", "tool")])
-    if verbose: pbar.update(1)
-    malwares = tc_src.query([Filter("type", "=", "malware")])
-    if verbose: pbar.update(1)
-    intrusion_sets = tc_src.query([Filter("type", "=", "intrusion-set")])
-    if verbose: pbar.update(1)
-    relationships = tc_src.query([Filter("type", "=", "relationship")])
-    if verbose: 
-        pbar.update(1)
-        print("") # tqdm needs a newline after the bar finishes
-
-    # parse technique, software, and groups into helper dictionaries
+    # parse technique, software, and groups into the graph
     if verbose: print("parsing data... ", end="", flush=True)
-    parse_techniques(techniques)
-    parse_software(tools_set)
-    parse_software(malwares)
-    parse_groups(intrusion_sets)
+    graph = Graph()
+    parse_techniques(graph, techniques)
+    parse_software(graph, tools_set)
+    parse_software(graph, malwares)
+    parse_groups(graph, intrusion_sets)
     # parse relationships between techniques, software, and groups
-    parse_relationships(relationships)
-    # pars the tactics -> permissions counter
-    parse_tactics()
+    parse_relationships(graph, relationships)
 
-    if verbose: 
+    if verbose and not dry_run:
         print("done!")
         print("writing output to directory " + output_directory + "... ", end="", flush=True)
 
-    # write output files
-    write_DPT(output_directory)
-    write_tacticsToTechniques(output_directory)
-    write_TSG(output_directory=output_directory)
-    # tsg is too big for visualization, so write a subset version
+    # tsg is too big for visualization, so write a subset version as well
     # select by tactics specified by user
     selected_techs=[]
-    for tech in tech_to_tac:
-        techniqueHasTactic = not set(tactics_to_visualize).isdisjoint(set(tech_to_tac[tech]))
+    for tech in graph.nodes("technique"):
+        techniqueHasTactic = any(graph.names[tac] in tactics_to_visualize for tac in graph.neighbors(tech, "tactic"))
         if techniqueHasTactic:
-            selected_techs.append(tech)
+            selected_techs.append(graph.names[tech])
 
-    write_TSG(selected_techs, output_directory)
-    # Write tactics -> permission file
-    write_tacticPermissions(output_directory)
-    # Write techniques + data sources
-    write_techniquesToDatasources(data_sources_list, output_directory)
+    if dry_run:
+        if verbose: print("done!")
+        for filename, specified_techniques in (("tsg", None), ("tsg_subset", selected_techs)):
+            if tsg_aggregate: filename += "_by_" + tsg_aggregate
+            print(f"{filename}.csv: about {estimate_TSG_rows(graph, specified_techniques, tsg_aggregate)} rows")
+        return graph
+
+    # write output files
+    write_outputs([
+        (write_DPT, (graph, output_directory)),
+        (write_tacticsToTechniques, (graph, output_directory)),
+        (write_TSG, (graph, None, output_directory, tsg_aggregate)),
+        (write_TSG, (graph, selected_techs, output_directory, tsg_aggregate)),
+        (write_tacticPermissions, (graph, output_directory)),
+        (write_techniquesToDatasources, (graph, data_sources_list, output_directory))
+    ])
     if verbose: print("done!")
+    return graph
 
 
 if __name__ == "__main__":
@@ -460,6 +578,14 @@ if __name__ == "__main__":
             (
                 "tsg_subset.csv",
                 "the same as tsg.csv but filtering to techniques in a subset of tactics"
+            ),
+            (
+                "tsg_by_group.csv\ntsg_subset_by_group.csv",
+                "written instead of tsg.csv and tsg_subset.csv with -tsg_aggregate group: the\nnumber of software linking each technique and group"
+            ),
+            (
+                "tsg_by_software.csv\ntsg_subset_by_software.csv",
+                "written instead of tsg.csv and tsg_subset.csv with -tsg_aggregate software:\nthe number of groups using each software implementing each technique"
             )
         ], 
         headers=("filename", "description"),
@@ -509,6 +635,25 @@ if __name__ == "__main__":
         default="generated_content",
         help="directory in which to put output csv." + defaultStr()
     )
+    parser.add_argument("-bundle",
+        type=str,
+        metavar="bundle_file",
+        dest="bundle_file",
+        default=None,
+        help="local STIX bundle of Enterprise ATT&CK to read instead of the TAXII server. If the file doesn't exist, the\ncollection is fetched from the TAXII server and saved to it for later runs."
+    )
+    parser.add_argument("-tsg_aggregate",
+        type=str,
+        choices=tsgAggregates.keys(),
+        default=None,
+        help="write aggregated counts instead of a row for each technique, software and group in tsg.csv and tsg_subset.csv."
+    )
+    parser.add_argument("--dry-run",
+        dest="dry_run",
+        action="store_true",
+        default=False,
+        help="print the estimated number of rows of tsg.csv and tsg_subset.csv instead of writing any output."
+    )
     parser.add_argument("-v", "--verbose",
         dest="verbose",
         action='store_true',
@@ -518,5 +663,5 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     verbose = args.verbose
-    generate_content(args.datasources, args.tactics, args.output_folder)
+    generate_content(args.datasources, args.tactics, args.output_folder, args.bundle_file, args.tsg_aggregate, args.dry_run)
    
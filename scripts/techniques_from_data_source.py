@@ -1,19 +1,66 @@
-from stix2 import TAXIICollectionSource, Filter
+from stix2 import TAXIICollectionSource, MemorySource, Filter
 from taxii2client.v20 import Collection
 import argparse
+import json
+import os
+import uuid
 
-# Establish TAXII2 Collection instance for Enterprise ATT&CK collection
-collection = Collection("https://cti-taxii.mitre.org/stix/collections/95ecc380-afe9-11e4-9b6c-751b66dd541e/")
-# Supply the collection to TAXIICollection
-tc_src = TAXIICollectionSource(collection)
+# the Enterprise ATT&CK collection on the ATT&CK TAXII server
+collection_url = "https://cti-taxii.mitre.org/stix/collections/95ecc380-afe9-11e4-9b6c-751b66dd541e/"
 
-def data_sources():
-    """returns all data sources in Enterprise ATT&CK"""
+# the data source queried by data_sources and techniques. It's only created on first use (see get_source), so
+# importing this module doesn't connect to the TAXII server
+tc_src = None
+
+def load_source(bundle_path):
+    """returns a MemorySource of the Enterprise ATT&CK objects in a local bundle file.
+
+    if the file doesn't exist yet, the collection is fetched from the TAXII server once and saved to it, so later
+    calls can work offline.
+    """
+
+    if os.path.exists(bundle_path):
+        src = MemorySource(allow_custom=True)
+        src.load_from_file(bundle_path)
+        return src
+
+    objects = [json.loads(obj.serialize()) for obj in TAXIICollectionSource(Collection(collection_url)).query()]
+    with open(bundle_path, "w") as f:
+        json.dump({"type": "bundle", "id": "bundle--" + str(uuid.uuid4()), "spec_version": "2.0", "objects": objects}, f)
+    return MemorySource(stix_data=objects, allow_custom=True)
+
+def set_source(source):
+    """sets the data source queried by data_sources and techniques.
+
+    arguments:
+        source: a stix2 DataSource such as a MemorySource, or the path of a local bundle file (see load_source)
+    """
+
+    global tc_src
+    tc_src = load_source(source) if isinstance(source, str) else source
+
+def get_source():
+    """returns the data source queried by data_sources and techniques, connecting to the TAXII server the first time if no other source was set."""
+
+    global tc_src
+    if tc_src is None:
+        # Establish TAXII2 Collection instance for Enterprise ATT&CK collection
+        collection = Collection(collection_url)
+        # Supply the collection to TAXIICollection
+        tc_src = TAXIICollectionSource(collection)
+    return tc_src
+
+def data_sources(src=None):
+    """returns all data sources in Enterprise ATT&CK.
+
+    arguments:
+        src: optional stix2 DataSource to query instead of the module's source (see get_source)
+    """
 
     all_data_srcs = []
 
     # Get all techniques in Enterprise ATT&CK
-    techniques = tc_src.query([Filter("type", "=", "attack-pattern")])
+    techniques = (src or get_source()).query([Filter("type", "=", "attack-pattern")])
 
     # Get all data sources in Enterprise ATT&CK
     for tech in techniques:
@@ -25,10 +72,15 @@ def data_sources():
     
     return all_data_srcs
 
-def techniques(data_source):
-    """returns all techniques which contain the given data source."""
+def techniques(data_source, src=None):
+    """returns all techniques which contain the given data source.
+
+    arguments:
+        data_source: the name of the data source
+        src: optional stix2 DataSource to query instead of the module's source (see get_source)
+    """
     
-    techs_with_data_src = tc_src.query([
+    techs_with_data_src = (src or get_source()).query([
         Filter("type", "=", "attack-pattern"),
         Filter("x_mitre_data_sources", "in", data_source)
     ])
@@ -44,8 +96,14 @@ if __name__ == "__main__":
         default="User Account: User Account Creation",
         help="the datasource by which to filter techniques. Default value is '%(default)s'."
     )
+    parser.add_argument("-bundle",
+        type=str,
+        default=None,
+        help="local STIX bundle of Enterprise ATT&CK to read instead of the TAXII server. If the file doesn't exist, the collection is fetched from the TAXII server and saved to it for later runs."
+    )
 
     args = parser.parse_args()
+    if args.bundle: set_source(args.bundle)
 
     print("All data sources in Enterprise ATT&CK:\n")
     print("\n".join(data_sources()))
@@ -0,0 +1,245 @@
+import io
+import json
+import os
+import random
+import tracemalloc
+
+import diff_stix
+from diff_stix import DiffStix, diff_releases, stream_bundle
+
+
+def technique(stix_id, attack_id, name, modified="2020-01-01T00:00:00.000Z", version="1.0", **extra):
+    technique = {
+        "type": "attack-pattern",
+        "id": stix_id,
+        "name": name,
+        "created": "2020-01-01T00:00:00.000Z",
+        "modified": modified,
+        "description": "description of " + name,
+        "external_references": [{
+            "source_name": "mitre-attack",
+            "external_id": attack_id,
+            "url": "https://attack.mitre.org/techniques/" + attack_id
+        }],
+        "kill_chain_phases": [{"kill_chain_name": "mitre-attack", "phase_name": "execution"}],
+        "x_mitre_version": version
+    }
+    technique.update(extra)
+    return technique
+
+
+def revoked_by(source_ref, target_ref):
+    return {
+        "type": "relationship",
+        "id": "relationship--00000000-0000-4000-8000-00000000000" + source_ref[-1],
+        "created": "2020-01-01T00:00:00.000Z",
+        "modified": "2020-01-01T00:00:00.000Z",
+        "relationship_type": "revoked-by",
+        "source_ref": source_ref,
+        "target_ref": target_ref
+    }
+
+
+def write_release(directory, objects):
+    os.makedirs(directory)
+    with open(os.path.join(directory, "enterprise-attack.json"), "w") as f:
+        json.dump({"type": "bundle", "id": "bundle--00000000-0000-4000-8000-000000000000", "spec_version": "2.0", "objects": objects}, f)
+    return str(directory)
+
+
+def test_diff_releases_matches_pairwise_diffs(tmp_path):
+    t1 = "attack-pattern--00000000-0000-4000-8000-000000000001"
+    t2 = "attack-pattern--00000000-0000-4000-8000-000000000002"
+    t3 = "attack-pattern--00000000-0000-4000-8000-000000000003"
+    releases = [
+        write_release(tmp_path / "a", [
+            technique(t1, "T1001", "First"),
+            technique(t2, "T1002", "Second"),
+            technique(t3, "T1003", "Third")
+        ]),
+        # First is revoked by Second, and Third changes
+        write_release(tmp_path / "b", [
+            technique(t1, "T1001", "First", modified="2020-02-01T00:00:00.000Z", revoked=True),
+            technique(t2, "T1002", "Second"),
+            technique(t3, "T1003", "Third", modified="2020-02-01T00:00:00.000Z", version="2.0"),
+            revoked_by(t1, t2)
+        ]),
+        # First is deleted, and Third changes again
+        write_release(tmp_path / "c", [
+            technique(t2, "T1002", "Second"),
+            technique(t3, "T1003", "Third", modified="2020-03-01T00:00:00.000Z", version="3.0")
+        ])
+    ]
+    options = {"domains": ["enterprise-attack"], "types": ["technique"], "minor_changes": True, "unchanged": True, "field_changes": True}
+
+    diffs = diff_releases(releases, summary=True, **options)
+
+    assert [(old, new) for old, new, _ in diffs] == [(releases[0], releases[1]), (releases[1], releases[2]), (releases[0], releases[2])]
+    for old, new, diff in diffs:
+        pairwise = DiffStix(old=old, new=new, **options)
+        assert list(diff.get_ndjson_records()) == list(pairwise.get_ndjson_records())
+        assert diff.data == pairwise.data
+
+
+def test_metrics_stops_tracing(tmp_path):
+    objects = [technique("attack-pattern--00000000-0000-4000-8000-000000000001", "T1001", "First")]
+    old = write_release(tmp_path / "old", objects)
+    new = write_release(tmp_path / "new", objects)
+
+    diff = DiffStix(old=old, new=new, domains=["enterprise-attack"], types=["technique"], metrics=True)
+    assert tracemalloc.is_tracing()
+    metrics = diff.get_metrics_dict()
+
+    assert not tracemalloc.is_tracing()
+    assert metrics["peak_memory"] > 0
+    assert diff.get_metrics_dict()["peak_memory"] == metrics["peak_memory"]
+    assert "parse" in metrics["seconds"]
+
+
+def sample_releases(tmp_path, count=40, seed=1):
+    """
+    Write an old and a new release with additions, deletions, major and minor changes, revocations, deprecations and
+    sub-techniques of each type, and return their directories.
+    """
+    rng = random.Random(seed)
+    stix_types = {"technique": "attack-pattern", "software": "malware", "group": "intrusion-set", "mitigation": "course-of-action"}
+    prefixes = {"technique": "T", "software": "S", "group": "G", "mitigation": "M"}
+    old = []
+    for n, (obj_type, stix_type) in enumerate(stix_types.items()):
+        for i in range(count):
+            stix_id = f"{stix_type}--00000000-0000-4000-8000-{n:04d}{i:08d}"
+            attack_id = f"{prefixes[obj_type]}{1000 + i}"
+            obj = technique(stix_id, attack_id, f"{obj_type} {rng.randrange(1000)}")
+            obj["type"] = stix_type
+            if stix_type != "attack-pattern":
+                del obj["kill_chain_phases"]
+            old.append(obj)
+    techniques = [obj for obj in old if obj["type"] == "attack-pattern"]
+    for i, parent in enumerate(techniques[:count // 4]):
+        sub = technique(f"attack-pattern--00000000-0000-4000-8000-9999{i:08d}", parent["external_references"][0]["external_id"] + ".001", f"sub {i}", x_mitre_is_subtechnique=True)
+        old.append(sub)
+        old.append({
+            "type": "relationship", "id": f"relationship--00000000-0000-4000-8000-9999{i:08d}",
+            "created": "2020-01-01T00:00:00.000Z", "modified": "2020-01-01T00:00:00.000Z",
+            "relationship_type": "subtechnique-of", "source_ref": sub["id"], "target_ref": parent["id"]
+        })
+
+    # the first object of each type is unchanged, and revokes the revoked objects of its type
+    revokers = {}
+    for obj in old:
+        revokers.setdefault(obj["type"], obj["id"])
+    new = []
+    for obj in old:
+        obj = json.loads(json.dumps(obj))
+        change = rng.random()
+        if obj["type"] == "relationship" or obj["id"] in revokers.values() or change < .4:
+            new.append(obj)
+            continue
+        if change < .5:
+            # deleted, unless it's the parent of a sub-technique
+            if obj in techniques[:count // 4]: new.append(obj)
+            continue
+        if change < .6:
+            obj["modified"], obj["x_mitre_version"], obj["description"] = "2020-03-01T00:00:00.000Z", "2.0", "changed"
+        elif change < .75:
+            obj["modified"], obj["x_mitre_platforms"] = "2020-02-01T00:00:00.000Z", ["Linux"]
+        elif change < .85:
+            obj["modified"], obj["x_mitre_deprecated"] = "2020-02-01T00:00:00.000Z", True
+        elif not obj.get("x_mitre_is_subtechnique") and obj not in techniques[:count // 4]:
+            obj["modified"], obj["revoked"] = "2020-02-01T00:00:00.000Z", True
+            new.append(dict(revoked_by(obj["id"], revokers[obj["type"]]), id=obj["id"].replace(obj["type"], "relationship")))
+        new.append(obj)
+    for i in range(5):
+        new.append(technique(f"attack-pattern--00000000-0000-4000-8000-8888{i:08d}", f"T2{i:03d}", f"added {i}"))
+    return write_release(tmp_path / "old", old), write_release(tmp_path / "new", new)
+
+
+def diff_outputs(diff):
+    """
+    Return the data, markdown and NDJSON output of a diff. The sections of the data are sorted by stixID, since their
+    order comes from set iteration and isn't part of the output.
+    """
+    markdown = io.StringIO()
+    diff.write_markdown(markdown)
+    data = {
+        obj_type: {
+            domain: {section: sorted(items, key=lambda item: item["id"]) for section, items in sections.items()}
+            for domain, sections in domains.items()
+        }
+        for obj_type, domains in diff.data.items()
+    }
+    return data, markdown.getvalue(), list(diff.get_ndjson_records())
+
+
+def test_loaders_match_default_loader(tmp_path):
+    old, new = sample_releases(tmp_path)
+    options = {"old": old, "new": new, "domains": ["enterprise-attack"], "minor_changes": True, "unchanged": True, "show_key": True}
+    expected = diff_outputs(DiffStix(**options))
+    assert all(expected[0]["technique"]["enterprise-attack"][section] for section in ["additions", "changes", "minor_changes", "deletions", "revocations", "deprecations"])
+
+    # a small run_size, so that several on-disk runs are merged
+    assert diff_outputs(DiffStix(low_memory=True, run_size=7, **options)) == expected
+    assert diff_outputs(DiffStix(jobs=2, **options)) == expected
+    cache_dir = str(tmp_path / "cache")
+    assert diff_outputs(DiffStix(cache_dir=cache_dir, **options)) == expected
+    # the second run diffs from the cache
+    assert diff_outputs(DiffStix(cache_dir=cache_dir, **options)) == expected
+
+
+def test_stream_bundle_chunk_sizes(tmp_path):
+    objects = [technique(f"attack-pattern--00000000-0000-4000-8000-{i:012d}", f"T{1000 + i}", f"Technique {i} é中") for i in range(3)]
+    path = tmp_path / "bundle.json"
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"type": "bundle", "num": 123456789, "flag": True, "objects": objects, "spec_version": "2.0", "last": -1.5e10}, f, ensure_ascii=False)
+    with open(path, "rb") as f:
+        content = f.read()
+
+    for chunk_size in range(1, 64):
+        streamed = list(stream_bundle(str(path), chunk_size=chunk_size))
+        assert [obj for obj, _, _ in streamed] == objects
+        assert [json.loads(content[start:end].decode("utf-8")) for _, start, end in streamed] == objects
+
+
+def test_relationship_diffs_leave_loaded_bundles_unchanged(tmp_path):
+    t1 = "attack-pattern--00000000-0000-4000-8000-000000000001"
+    g1 = "intrusion-set--00000000-0000-4000-8000-000000000001"
+    group = dict(technique(g1, "G0001", "Group"), type="intrusion-set")
+    del group["kill_chain_phases"]
+    uses = {
+        "type": "relationship", "id": "relationship--00000000-0000-4000-8000-000000000001",
+        "created": "2020-01-01T00:00:00.000Z", "modified": "2020-01-01T00:00:00.000Z",
+        "relationship_type": "uses", "source_ref": g1, "target_ref": t1, "description": "uses"
+    }
+    releases = [
+        write_release(tmp_path / "a", [technique(t1, "T1001", "First"), group]),
+        write_release(tmp_path / "b", [technique(t1, "T1001", "First"), group, uses]),
+        write_release(tmp_path / "c", [technique(t1, "T1001", "First"), group, dict(uses, description="changed")])
+    ]
+    options = {"domains": ["enterprise-attack"], "types": ["technique", "group", "relationship"]}
+
+    diffs = diff_releases(releases, **options)
+
+    for old, new, diff in diffs:
+        assert diff.data == DiffStix(old=old, new=new, **options).data
+    loaded_bundles = {}
+    DiffStix(old=releases[0], new=releases[1], loaded_bundles=loaded_bundles, **options)
+    for loaded in loaded_bundles.values():
+        for relationship in loaded["id_to_obj"]["relationship"].values():
+            assert "source_name" not in relationship and "target_name" not in relationship
+
+
+def test_bundle_cache_saves_new_mtime(tmp_path, monkeypatch):
+    old, new = sample_releases(tmp_path, count=5)
+    options = {"old": old, "new": new, "domains": ["enterprise-attack"], "cache_dir": str(tmp_path / "cache")}
+    expected = diff_outputs(DiffStix(**options))
+
+    # touch the new bundle without changing its content
+    bundle = os.path.join(new, "enterprise-attack.json")
+    os.utime(bundle, (os.stat(bundle).st_atime, os.stat(bundle).st_mtime + 10))
+    assert diff_outputs(DiffStix(**options)) == expected
+
+    # the cache now has the new modification time, so the bundle isn't hashed again
+    def no_hashing(*args):
+        raise AssertionError("the bundle was hashed again")
+    monkeypatch.setattr(diff_stix.hashlib, "sha256", no_hashing)
+    assert diff_outputs(DiffStix(**options)) == expected
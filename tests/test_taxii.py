@@ -0,0 +1,135 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from taxii2client.v20 import Collection
+
+import diff_stix
+from diff_stix import DiffStix, fetch_taxii_objects
+from test_diff_stix import technique
+
+COLLECTION_ID = diff_stix.domainToTaxiiCollectionId["enterprise-attack"]
+
+
+class StandInTaxiiServer(ThreadingHTTPServer):
+    """
+    A TAXII 2.0 server with one collection, which pages its objects by the Range header.
+
+    paging is "content-range" to report the total in the Content-Range header, "416" to answer 416 Range Not
+    Satisfiable past the last object, or "short" to only return short pages. If max_page is given, no page holds more
+    than max_page objects, whatever the Range header asks for.
+    """
+    def __init__(self, objects, paging, max_page=None):
+        super().__init__(("127.0.0.1", 0), StandInTaxiiHandler)
+        self.objects = objects
+        self.paging = paging
+        self.max_page = max_page
+        self.object_requests = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}/collections/"
+
+
+class StandInTaxiiHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, content_type, body, headers={}):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode("utf-8"))
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == f"/collections/{COLLECTION_ID}/":
+            collection = {"id": COLLECTION_ID, "title": "Enterprise ATT&CK", "can_read": True, "can_write": False, "media_types": ["application/vnd.oasis.stix+json; version=2.0"]}
+            return self.send_json(200, "application/vnd.oasis.taxii+json; version=2.0", collection)
+        if path != f"/collections/{COLLECTION_ID}/objects/":
+            return self.send_json(404, "application/vnd.oasis.taxii+json; version=2.0", {"title": "not found"})
+
+        self.server.object_requests += 1
+        objects = self.server.objects
+        start, end = 0, len(objects) - 1
+        match = re.match(r"^items[= ](\d+)-(\d+)$", self.headers.get("Range", ""))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+        if start >= len(objects) and self.server.paging == "416":
+            return self.send_json(416, "application/vnd.oasis.taxii+json; version=2.0", {"title": "range not satisfiable"})
+        if self.server.max_page:
+            end = min(end, start + self.server.max_page - 1)
+        page = objects[start:end + 1]
+        headers = {}
+        if self.server.paging == "content-range":
+            headers["Content-Range"] = f"items {start}-{start + len(page) - 1}/{len(objects)}"
+        bundle = {"type": "bundle", "id": "bundle--00000000-0000-4000-8000-000000000000", "spec_version": "2.0", "objects": page}
+        self.send_json(206 if match else 200, "application/vnd.oasis.stix+json; version=2.0", bundle, headers)
+
+
+@pytest.fixture
+def taxii_server(request):
+    servers = []
+    def start(objects, paging="content-range", max_page=None):
+        server = StandInTaxiiServer(objects, paging, max_page)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def techniques(count):
+    return [
+        technique(f"attack-pattern--00000000-0000-4000-8000-{i:012d}", f"T{1000 + i}", f"Technique {i}")
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize("paging,count,max_page", [
+    ("content-range", 25, None),
+    ("416", 20, None), # a multiple of the page size, so only the 416 ends the paging
+    ("short", 25, None),
+    # servers which cap their pages below per_request
+    ("content-range", 25, 4),
+    ("content-range", 25, 3), # the last page is short
+    ("416", 25, 4),
+    ("short", 25, 4)
+])
+def test_fetch_taxii_objects_pages(taxii_server, paging, count, max_page):
+    objects = techniques(count)
+    server = taxii_server(objects, paging, max_page)
+
+    fetched = fetch_taxii_objects(Collection(server.url + COLLECTION_ID + "/"), per_request=10)
+
+    assert sorted(fetched, key=lambda obj: obj["id"]) == objects
+
+
+def test_taxii_snapshot_cache(taxii_server, tmp_path, monkeypatch, capsys):
+    objects = techniques(5)
+    server = taxii_server(objects)
+    monkeypatch.setattr(diff_stix, "taxiiCollectionsUrl", server.url)
+    new = tmp_path / "new"
+    new.mkdir()
+    with open(new / "enterprise-attack.json", "w") as f:
+        json.dump({"type": "bundle", "id": "bundle--00000000-0000-4000-8000-000000000000", "spec_version": "2.0", "objects": objects[1:]}, f)
+    options = {"domains": ["enterprise-attack"], "types": ["technique"], "new": str(new), "use_taxii": True, "cache_dir": str(tmp_path / "cache")}
+
+    first = DiffStix(**options)
+    requests = server.object_requests
+    assert requests > 0
+    assert "WARNING" not in capsys.readouterr().out
+
+    # the snapshot is used instead of fetching the collection again, with a warning
+    cached = DiffStix(**options)
+    assert server.object_requests == requests
+    assert "--refresh-taxii" in capsys.readouterr().out
+    assert list(cached.get_ndjson_records()) == list(first.get_ndjson_records())
+    assert [record["section"] for record in cached.get_ndjson_records()] == ["deletions"]
+
+    # refresh_taxii fetches the collection again
+    DiffStix(refresh_taxii=True, **options)
+    assert server.object_requests > requests